@@ -0,0 +1,189 @@
+import argparse
+import time
+import numpy as np
+
+from similarity import SimilarityEngine
+
+
+def spherical_kmeans(matrix, n_clusters, iterations=10, train_size=100_000, seed=0):
+    # Unit-length centroids of L2-normalized rows, trained on a sample of at most train_size rows
+    rng = np.random.default_rng(seed)
+    sample = matrix
+    if len(matrix) > train_size:
+        sample = matrix[rng.choice(len(matrix), train_size, replace=False)]
+
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+
+        # Clusters that lost all their rows are restarted from random rows
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), np.count_nonzero(empty))]
+        centroids = SimilarityEngine._normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    # Approximate cosine-similarity search with an inverted file (IVF) index.
+    # Rows are clustered with spherical k-means and stored grouped by cluster; a query only
+    # scans the `n_probe` clusters whose centroids are closest to it.
+    # Recall/speed knobs: more `n_lists` means smaller clusters (faster, lower recall),
+    # more `n_probe` means more clusters scanned per query (slower, higher recall).
+
+    def __init__(self, n_lists=None, n_probe=8, train_size=100_000, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_size = train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.source = None  # Identifies the feature store the index was built from, row positions only apply to it
+        self.centroids = None
+        self.ids = None
+        self.vectors = None
+        self.offsets = None
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def fit(self, features, source=None):
+        self.source = source
+        matrix = SimilarityEngine._normalize(features)
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(len(matrix))))
+        self.n_lists = min(self.n_lists, len(matrix))
+
+        self.centroids = self._train_centroids(matrix)
+        assignments = self._assign(matrix)
+
+        # Store the rows grouped by cluster so every cluster is one contiguous slice
+        order = np.argsort(assignments, kind='stable')
+        self.ids = order
+        self.vectors = matrix[order]
+        self.offsets = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+        return self
+
+    def _train_centroids(self, matrix):
+        return spherical_kmeans(matrix, self.n_lists, iterations=self.iterations, train_size=self.train_size, seed=self.seed)
+
+    def _assign(self, matrix, chunk_size=16384):
+        # Chunked so the rows x lists score matrix never has to fit in memory at once
+        assignments = np.empty(len(matrix), dtype=np.intp)
+        for start in range(0, len(matrix), chunk_size):
+            chunk = matrix[start:start + chunk_size]
+            assignments[start:start + chunk_size] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignments
+
+    def query(self, vector, k=10, exclude=None, n_probe=None):
+        # Same contract as SimilarityEngine.query: (indices, scores) best match first
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        query_vector = SimilarityEngine._normalize(vector)[0]
+
+        lists = np.argpartition(-(self.centroids @ query_vector), n_probe - 1)[:n_probe]
+        candidates = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+        candidate_ids = self.ids[candidates]
+        scores = self.vectors[candidates] @ query_vector
+        if exclude is not None:
+            scores[np.isin(candidate_ids, exclude)] = -np.inf
+            k = min(k, len(scores) - np.count_nonzero(np.isneginf(scores)))
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return candidate_ids[top], scores[top]
+
+    def query_batch(self, matrix, k=10, exclude=None, n_probe=None):
+        # Same contract as SimilarityEngine.query_batch. Every query probes its own lists, so queries are
+        # answered one by one. A query whose probed lists hold fewer than k rows keeps what it found, and the
+        # rest of its row is padded with index -1 and score -inf.
+        matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+        results = [self.query(vector, k, None if exclude is None else exclude[row], n_probe)
+                   for row, vector in enumerate(matrix)]
+        width = max([len(row_indices) for row_indices, _ in results], default=0)
+        indices = np.full((len(results), width), -1, dtype=np.intp)
+        scores = np.full((len(results), width), -np.inf, dtype=np.float32)
+        for row, (row_indices, row_scores) in enumerate(results):
+            indices[row, :len(row_indices)] = row_indices
+            scores[row, :len(row_scores)] = row_scores
+        return indices, scores
+
+    def save(self, path):
+        # Written through a file object so numpy does not append ".npz" to the path
+        with open(path, 'wb') as index_file:
+            np.savez(index_file, centroids=self.centroids, ids=self.ids, vectors=self.vectors, offsets=self.offsets,
+                     n_probe=self.n_probe, source=np.array(self.source or ""))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(n_lists=len(data['centroids']), n_probe=int(data['n_probe']))
+            index.centroids = data['centroids']
+            index.ids = data['ids']
+            index.vectors = data['vectors']
+            index.offsets = data['offsets']
+            # Indexes saved before the source was recorded match no store and get rebuilt
+            index.source = str(data['source']) if 'source' in data.files else None
+        return index
+
+
+def recall_at_k(index, exact, queries, k=10, n_probe=None):
+    # Fraction of the exact top-k neighbours (from a SimilarityEngine) that the index also returns
+    hits = 0
+    for vector in queries:
+        expected = exact.query(vector, k)[0]
+        found = index.query(vector, k, n_probe=n_probe)[0]
+        hits += len(np.intersect1d(expected, found))
+    return hits / (k * len(queries))
+
+
+def synthetic_features(rows=1_000_000, dims=13, seed=0):
+    # Clustered synthetic data behaves more like real audio features than pure noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((256, dims))
+    return centers[rng.integers(0, len(centers), rows)] + 0.5 * rng.standard_normal((rows, dims))
+
+
+def report(features, n_lists=None, probes=(1, 4, 8, 16, 32), k=10, queries=200, seed=0):
+    # Queries are catalog rows with a little noise, like a seed track that is close to but not in the catalog
+    rng = np.random.default_rng(seed)
+    rows, dims = features.shape
+    queries = min(queries, rows)
+    vectors = features[rng.choice(rows, queries, replace=False)] + 0.1 * rng.standard_normal((queries, dims))
+
+    start = time.perf_counter()
+    index = IVFIndex(n_lists=n_lists).fit(features)
+    print(f"Built IVF index over {rows} rows with {index.n_lists} lists in {time.perf_counter() - start:.1f} s")
+
+    exact = SimilarityEngine(features)
+    start = time.perf_counter()
+    for vector in vectors:
+        exact.query(vector, k)
+    print(f"exact search: {(time.perf_counter() - start) / queries * 1000:8.3f} ms/query")
+
+    for n_probe in probes:
+        start = time.perf_counter()
+        for vector in vectors:
+            index.query(vector, k, n_probe=n_probe)
+        query_ms = (time.perf_counter() - start) / queries * 1000
+        recall = recall_at_k(index, exact, vectors, k, n_probe)
+        print(f"n_probe={n_probe:<4} {query_ms:8.3f} ms/query  recall@{k}={recall:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report IVF index speed and recall against exact search.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="rows of synthetic data")
+    parser.add_argument("--catalog", help="measure on this crawl's scaled audio features (e.g. song_new.csv) instead")
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+    if args.catalog:
+        from feature_store import load_feature_store
+        # The same scaled columns app1.py searches (its fit_columns)
+        features = np.asarray(load_feature_store(args.catalog).scaled)
+    else:
+        features = synthetic_features(args.rows)
+    report(features, n_lists=args.lists, probes=args.probes)
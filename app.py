@@ -1,31 +1,64 @@
 import os
 import json
-import random
+import threading
 import spacy
-from flask import Flask, request, render_template, jsonify, session
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyOAuth
+from flask import Flask, request, render_template, jsonify, session, g, Response, stream_with_context
+from spotipy.cache_handler import MemoryCacheHandler
 import logging
 import openai
-from flask_session import Session
+from caching import LRUCache, RequestCoalescer
+from spotify_clients import SpotifyClientCache, spotify_oauth
+from spotify_cache import SpotifyResponseCache, CachedSpotify
+from user_state import UserState
+from genre_pool import GenrePools
+from state_store import StateStore, StateSessionInterface
+import metrics
+from metrics import span
 
 # Loav environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
 model_name = os.environ.get("SPACY_MODEL", "en_core_web_sm")
+# extract_preferences only reads doc.ents, so every component NER doesn't depend on is left out
+SPACY_EXCLUDE = ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+PREFERENCES_CACHE_SIZE = int(os.environ.get("PREFERENCES_CACHE_SIZE", "4096"))
+# Load the model before serving instead of in the background. gunicorn.conf.py sets this so the model is
+# loaded once before the workers are forked: threads don't survive a fork.
+SPACY_PRELOAD = os.environ.get("SPACY_PRELOAD", "0") == "1"
+
+# OpenAI fallback answers are cached per normalized prompt and model parameters
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "20"))  # Seconds before an upstream call is abandoned
+OPENAI_CACHE_SIZE = int(os.environ.get("OPENAI_CACHE_SIZE", "1024"))
+OPENAI_CACHE_TTL = int(os.environ.get("OPENAI_CACHE_TTL", "3600"))  # Seconds
 
 # Load spaCy model
 def load_model():
     try:
-        nlp = spacy.load(model_name)
+        nlp = spacy.load(model_name, exclude=SPACY_EXCLUDE)
         return nlp
     except OSError as e:
         print(f"Model '{model_name}' not found. Downloading...")
         spacy.cli.download(model_name)
-        nlp = spacy.load(model_name)
+        nlp = spacy.load(model_name, exclude=SPACY_EXCLUDE)
         return nlp
-    
+
+def load_model_in_background(background=True):
+    # The app starts answering right away, messages are handled without NER until the model is ready
+    def load():
+        global nlp
+        try:
+            nlp = load_model()
+        except Exception as e:
+            logger.error(f"Error loading spaCy model: {e}")
+        finally:
+            nlp_loaded.set()
+
+    if not background:
+        load()
+        return
+    threading.Thread(target=load, name="spacy-loader", daemon=True).start()
+
 
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET")
@@ -33,66 +66,143 @@ redirect_uri = "http://localhost:5000/callback"
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'supersecretkey'
-app.config['SESSION_TYPE'] = 'filesystem'
-Session(app)
+# Sessions, chat state and Spotify tokens live in a SQLite file shared by all worker processes
+state_store = StateStore()
+app.session_interface = StateSessionInterface(state_store)
+metrics.init_app(app, store=state_store)  # GET /metrics, summed over all workers, and the Server-Timing header
 
-# Initialize Spotipy with user authorization
-sp_oauth = SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri, scope="user-library-read")
+# Initialize Spotipy with user authorization, tokens are kept per user in spotify_clients instead of a shared cache file
+sp_oauth = spotify_oauth(client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri, scope="user-library-read", cache_handler=MemoryCacheHandler())
+spotify_clients = SpotifyClientCache(client_id, client_secret, redirect_uri, scope="user-library-read", store=state_store)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging, LOG_LEVEL=DEBUG also logs every upstream HTTP request
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # Load spaCy model
-nlp = load_model()
+nlp = None
+nlp_loaded = threading.Event()
+load_model_in_background(background=not SPACY_PRELOAD)
 
-# Store user preferences and recommendations
-user_preferences = {
-    "genres": [],
-    "liked_songs": []
-}
+# Extracted (genres, artists) keyed by normalized message text
+preferences_cache = LRUCache(maxsize=PREFERENCES_CACHE_SIZE)
 
-# Track previously recommended songs
-previous_recommendations = {
-    "genres": {}
-}
+openai_cache = LRUCache(maxsize=OPENAI_CACHE_SIZE, ttl=OPENAI_CACHE_TTL)
+openai_coalescer = RequestCoalescer()
+
+# Search, recommendations and related-artists responses, shared by all users
+spotify_cache = SpotifyResponseCache()
+
+# Prefetched genre search results, shared by all users
+genre_pools = GenrePools()
+
+# Preferences and recommendation history per session are kept in the state store, see user_state.py for the size bounds
+USER_STATE_NAMESPACE = "user_state"
+
+LOGIN_MESSAGE = "Your Spotify session has expired. Please log in with Spotify again."
 
 def get_spotify_auth_url():
     auth_url = sp_oauth.get_authorize_url()
     return auth_url
 
-def get_spotify_token(auth_code):
-    token_info = sp_oauth.get_access_token(auth_code)
-    return token_info['access_token']
+def get_spotify_token_info(auth_code):
+    return sp_oauth.get_access_token(auth_code, check_cache=False)
 
-def get_token():
-    with open("token.json", "r") as token_file:
-        token_data = json.load(token_file)
-    return token_data["access_token"]
+def get_user_state():
+    # Loaded once per request, save_user_state() writes it back after the reply
+    if 'user_state' not in g:
+        g.user_state = state_store.get(USER_STATE_NAMESPACE, session.sid) or UserState()
+    return g.user_state
+
+def save_user_state():
+    if 'user_state' in g:
+        state_store.set(USER_STATE_NAMESPACE, session.sid, g.user_state, ttl=app.permanent_session_lifetime.total_seconds())
+
+def get_spotify_client():
+    sp = spotify_clients.get(session.get('spotify_client'))
+    return CachedSpotify(sp, spotify_cache) if sp is not None else None
+
+def normalize_prompt(question):
+    # "What is shoegaze?" and "what is  shoegaze" share one cache entry
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+OPENAI_PARAMS = {
+    "model": "gpt-3.5-turbo",  # or "gpt-4" if you have access
+    "max_tokens": 150,
+    "temperature": 0.7,
+}
+
+def openai_cache_key(question):
+    return (normalize_prompt(question), tuple(sorted(OPENAI_PARAMS.items())))
+
+def openai_messages(question):
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": question},
+    ]
+
+def openai_error_message(e):
+    logger.error(f"Error calling OpenAI API: {e}")
+    if isinstance(e, openai.error.RateLimitError):
+        return "I'm sorry, but the service is currently experiencing high demand. Please try again later."
+    elif isinstance(e, openai.error.InvalidRequestError):
+        return "I'm sorry, but we have exceeded our current quota. Please check back later."
+    else:
+        return "I'm sorry, but I couldn't process your request at the moment."
+
+def request_openai_completion(question):
+    response = openai.ChatCompletion.create(
+        messages=openai_messages(question),
+        n=1,
+        stop=None,
+        request_timeout=OPENAI_TIMEOUT,
+        **OPENAI_PARAMS,
+    )
+    return response['choices'][0]['message']['content'].strip()
 
 def ask_openai(question):
+    key = openai_cache_key(question)
+    answer = openai_cache.get(key)
+    if answer is not None:
+        return answer
+
+    def fetch():
+        answer = request_openai_completion(question)
+        openai_cache.set(key, answer)
+        return answer
+
+    try:
+        # Concurrent identical prompts wait for the first caller's request instead of sending their own
+        return openai_coalescer.run(key, fetch)
+    except openai.error.OpenAIError as e:
+        return openai_error_message(e)
+
+def stream_openai(question):
+    # Streaming version of ask_openai: yields tokens as they arrive and caches the full answer
+    key = openai_cache_key(question)
+    answer = openai_cache.get(key)
+    if answer is not None:
+        yield answer
+        return
+
     try:
         response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",  # or "gpt-4" if you have access
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": question},
-            ],
-            max_tokens=150,
+            messages=openai_messages(question),
             n=1,
             stop=None,
-            temperature=0.7,
+            request_timeout=OPENAI_TIMEOUT,
+            stream=True,
+            **OPENAI_PARAMS,
         )
-        return response['choices'][0]['message']['content'].strip()
+        parts = []
+        for chunk in response:
+            delta = chunk['choices'][0]['delta'].get('content')
+            if delta:
+                parts.append(delta)
+                yield delta
+        openai_cache.set(key, "".join(parts).strip())
     except openai.error.OpenAIError as e:
-        logger.error(f"Error calling OpenAI API: {e}")
-        if isinstance(e, openai.error.RateLimitError):
-            return "I'm sorry, but the service is currently experiencing high demand. Please try again later."
-        elif isinstance(e, openai.error.InvalidRequestError):
-            return "I'm sorry, but we have exceeded our current quota. Please check back later."
-        else:
-            return "I'm sorry, but I couldn't process your request at the moment."
+        yield openai_error_message(e)
 
 
 @app.route('/')
@@ -104,20 +214,28 @@ def index():
         logger.error(f"Error in index route: {e}")
         return "An error occurred in the index route."
 
+@app.route('/cache/stats')
+def cache_stats():
+    openai_stats = openai_cache.stats()
+    openai_stats["coalesced"] = openai_coalescer.coalesced
+    return jsonify({"openai": openai_stats, "preferences": preferences_cache.stats(), "spotify": spotify_cache.stats()})
+
 @app.route('/callback')
 def callback():
     try:
         auth_code = request.args.get('code')
-        token = get_spotify_token(auth_code)
-        with open("token.json", "w") as token_file:
-            json.dump({"access_token": token}, token_file)
+        token_info = get_spotify_token_info(auth_code)
+        session['spotify_client'] = spotify_clients.add(token_info)
         return render_template('chat.html')
     except Exception as e:
         logger.error(f"Error in callback route: {e}")
         return "An error occurred in the callback route."
 
-def extract_preferences(user_message):
-    doc = nlp(user_message)
+def normalize_message(user_message):
+    # Whitespace only, NER depends on capitalization
+    return " ".join(user_message.split())
+
+def preferences_from_doc(doc):
     genres = []
     artists = []
     for ent in doc.ents:
@@ -127,117 +245,194 @@ def extract_preferences(user_message):
             artists.append(ent.text)
     return genres, artists
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    try:
-        user_message = request.json.get('message')
-        token = get_token()
-        sp = Spotify(auth=token)
-        
-        if 'state' not in session:
-            session['state'] = 'initial'
-        
-        if session['state'] == 'initial':
+def extract_preferences(user_message):
+    key = normalize_message(user_message)
+    preferences = preferences_cache.get(key)
+    if preferences is None:
+        if nlp is None:
+            return [], []
+        preferences = preferences_from_doc(nlp(key))
+        preferences_cache.set(key, preferences)
+    genres, artists = preferences
+    return list(genres), list(artists)
+
+def extract_preferences_batch(user_messages, batch_size=256):
+    # Bulk path: waits for the model and runs all uncached messages through nlp.pipe
+    nlp_loaded.wait()
+    keys = [normalize_message(user_message) for user_message in user_messages]
+    extracted = {}
+    for key in dict.fromkeys(keys):
+        preferences = preferences_cache.get(key)
+        if preferences is not None:
+            extracted[key] = preferences
+    missing = [key for key in dict.fromkeys(keys) if key not in extracted]
+    for key, doc in zip(missing, nlp.pipe(missing, batch_size=batch_size)):
+        extracted[key] = preferences_from_doc(doc)
+        preferences_cache.set(key, extracted[key])
+    return [(list(extracted[key][0]), list(extracted[key][1])) for key in keys]
+
+def chat_replies(user_message, sp, stream=False):
+    # The chat state machine. Yields the reply in pieces that concatenate to the full message,
+    # so /chat can join them and /chat/stream can send each piece as soon as it is known.
+    if session['state'] == 'initial':
+        user_state = get_user_state()
+        with span("extract_preferences"):
             genres, artists = extract_preferences(user_message)
-            user_preferences["genres"].extend(genres)
-            
-            if 'recommend' in user_message.lower():
-                song_query = user_message.lower().replace('recommend', '').strip()
-                if not song_query:
-                    return jsonify({"message": "Please specify a song name after 'recommend'."})
+        user_state.genres.extend(genres)
+        
+        if 'recommend' in user_message.lower():
+            song_query = user_message.lower().replace('recommend', '').strip()
+            if not song_query:
+                yield "Please specify a song name after 'recommend'."
+                return
 
-                # Search for the song based on user input
+            # Search for the song based on user input
+            with span("spotify_search"):
                 search_results = sp.search(q=song_query, type='track', limit=5)
-                if not search_results['tracks']['items']:
-                    return jsonify({"message": "Song not found. Please try another song name."})
-                
-                song = search_results['tracks']['items'][0]
-                song_id = song['id']
-                song_name = f"{song['artists'][0]['name']} - {song['name']}"
-                
-                # Get recommendations based on the song
-                recommendations = sp.recommendations(seed_tracks=[song_id], limit=10)
-                recommended_songs = recommendations['tracks']
-
-                response_message = f"Here are some songs you might like based on {song_name}:<br>" + "<br>".join([f"{track['artists'][0]['name']} - {track['name']}" for track in recommended_songs])
-                response_message += "<br>Did you like these recommendations? (yes/no)"
-                session['state'] = 'recommendation_feedback'
+            if not search_results['tracks']['items']:
+                yield "Song not found. Please try another song name."
+                return
+            
+            song = search_results['tracks']['items'][0]
+            song_id = song['id']
+            song_name = f"{song['artists'][0]['name']} - {song['name']}"
+            yield f"Here are some songs you might like based on {song_name}:"
             
-            elif 'similar artist' in user_message.lower():
-                artist_query = user_message.lower().replace('similar artist', '').strip()
-                if not artist_query:
-                    return jsonify({"message": "Please specify an artist name after 'similar artist'."})
+            # Get recommendations based on the song
+            with span("spotify_recommendations"):
+                recommendations = sp.recommendations(seed_tracks=[song_id], limit=10)
+            # Only once the reply is complete, so a failed call leaves the conversation where it was
+            session['state'] = 'recommendation_feedback'
+            for track in recommendations['tracks']:
+                yield f"<br>{track['artists'][0]['name']} - {track['name']}"
+            yield "<br>Did you like these recommendations? (yes/no)"
+        
+        elif 'similar artist' in user_message.lower():
+            artist_query = user_message.lower().replace('similar artist', '').strip()
+            if not artist_query:
+                yield "Please specify an artist name after 'similar artist'."
+                return
 
+            with span("spotify_search"):
                 search_results = sp.search(q=artist_query, type='artist', limit=10)
-                if not search_results['artists']['items']:
-                    return jsonify({"message": "Artist not found. Please try another artist name."})
+            if not search_results['artists']['items']:
+                yield "Artist not found. Please try another artist name."
+                return
 
-                artist = search_results['artists']['items'][0]
-                artist_id = artist['id']
-                artist_name = artist['name']
-                
-                recommendations = sp.artist_related_artists(artist_id)
-                recommended_artists = recommendations['artists']
-                
-                response_message = f"Here are some artists you might like based on {artist_name}:<br>" + "<br>".join([f"{artist['name']}" for artist in recommended_artists])
-                response_message += "<br>Do you like these artists? (yes/no)"
-                session['state'] = 'artist_feedback'
+            artist = search_results['artists']['items'][0]
+            artist_id = artist['id']
+            artist_name = artist['name']
+            yield f"Here are some artists you might like based on {artist_name}:"
             
-            elif 'genre' in user_message.lower():
-                genre_query = user_message.lower().replace('genre', '').strip()
-                if not genre_query:
-                    return jsonify({"message": "Please specify a genre after 'genre'."})
-
-                # Get recommendations based on the genre
-                search_results = sp.search(q=f"genre:{genre_query}", type='track', limit=50)
-                recommended_songs = search_results['tracks']['items']
-                random.shuffle(recommended_songs)  # Shuffle the list to get different songs each time
-                
-                if genre_query not in previous_recommendations["genres"]:
-                    previous_recommendations["genres"][genre_query] = []
-
-                unique_artists = {}
-                unique_songs = []
-                for song in recommended_songs:
-                    artist_name = song['artists'][0]['name']
-                    if artist_name not in unique_artists and song['id'] not in previous_recommendations["genres"][genre_query]:
-                        unique_artists[artist_name] = True
-                        unique_songs.append(song)
-                        previous_recommendations["genres"][genre_query].append(song['id'])
-                    if len(unique_songs) == 5:
-                        break
-
-                response_message = f"Here are some songs in the {genre_query} genre:<br>" + "<br>".join([f"{track['artists'][0]['name']} - {track['name']}" for track in unique_songs])
-                session['state'] = 'genre_feedback'
-            
-            else:
-                response_message = ask_openai(user_message)
-
-        elif session['state'] in ['recommendation_feedback', 'artist_feedback', 'genre_feedback']:
-            if 'yes' in user_message.lower():
-                response_message = "Thank you! Do you want to continue using the chatbot? (yes/no)"
-                session['state'] = 'continue'
-            elif 'no' in user_message.lower():
-                response_message = "Thank you for your feedback! Have a great day!"
-                session['state'] = 'initial'
-            else:
-                response_message = "Please answer with 'yes' or 'no'."
-
-        elif session['state'] == 'continue':
-            if 'yes' in user_message.lower():
-                response_message = "I can help you find song or artist recommendations. Just type 'recommend' followed by a song name, 'similar artist' followed by an artist name, or 'genre' followed by a genre."
-                session['state'] = 'initial'
-            elif 'no' in user_message.lower():
-                response_message = "Thank you for using the chatbot! Have a great day!"
-                session['state'] = 'initial'
-            else:
-                response_message = "Please answer with 'yes' or 'no'."
+            with span("spotify_related_artists"):
+                recommendations = sp.artist_related_artists(artist_id)
+            session['state'] = 'artist_feedback'
+            for artist in recommendations['artists']:
+                yield f"<br>{artist['name']}"
+            yield "<br>Do you like these artists? (yes/no)"
+        
+        elif 'genre' in user_message.lower():
+            genre_query = user_message.lower().replace('genre', '').strip()
+            if not genre_query:
+                yield "Please specify a genre after 'genre'."
+                return
+
+            yield f"Here are some songs in the {genre_query} genre:"
+
+            # Candidates come from the genre's prefetched pool, minus tracks this user was already given
+            def fetch_page(offset):
+                return list(sp.search(q=f"genre:{genre_query}", type='track', limit=50, offset=offset)['tracks']['items'])
+
+            with span("genre_pool"):
+                unique_songs = genre_pools.take(genre_query, fetch_page, count=5,
+                                                accept=lambda song: not user_state.history.seen(genre_query, song['id']))
+            session['state'] = 'genre_feedback'
+            for song in unique_songs:
+                user_state.history.add(genre_query, song['id'])
+                yield f"<br>{song['artists'][0]['name']} - {song['name']}"
+        
+        elif stream:
+            # Includes the time the client takes to receive each token
+            with span("openai_stream"):
+                yield from stream_openai(user_message)
+        else:
+            with span("ask_openai"):
+                answer = ask_openai(user_message)
+            yield answer
+
+    elif session['state'] in ['recommendation_feedback', 'artist_feedback', 'genre_feedback']:
+        if 'yes' in user_message.lower():
+            yield "Thank you! Do you want to continue using the chatbot? (yes/no)"
+            session['state'] = 'continue'
+        elif 'no' in user_message.lower():
+            yield "Thank you for your feedback! Have a great day!"
+            session['state'] = 'initial'
+        else:
+            yield "Please answer with 'yes' or 'no'."
+
+    elif session['state'] == 'continue':
+        if 'yes' in user_message.lower():
+            yield "I can help you find song or artist recommendations. Just type 'recommend' followed by a song name, 'similar artist' followed by an artist name, or 'genre' followed by a genre."
+            session['state'] = 'initial'
+        elif 'no' in user_message.lower():
+            yield "Thank you for using the chatbot! Have a great day!"
+            session['state'] = 'initial'
+        else:
+            yield "Please answer with 'yes' or 'no'."
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    try:
+        user_message = request.json.get('message')
+        sp = get_spotify_client()
+        if sp is None:
+            return jsonify({"message": LOGIN_MESSAGE})
+        
+        if 'state' not in session:
+            session['state'] = 'initial'
 
+        response_message = "".join(chat_replies(user_message, sp))
+        save_user_state()
         return jsonify({"message": response_message})
     except Exception as e:
         logger.error(f"Error in chat route: {e}")
         return jsonify({"message": "An error occurred while processing your request."})
 
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    # Same conversation as /chat, sent as Server-Sent Events: one "message" event per reply
+    # piece followed by a "done" event
+    user_message = request.json.get('message')
+    sp = get_spotify_client()
+
+    # Set before the response starts so the session cookie goes out with the headers
+    if 'state' not in session:
+        session['state'] = 'initial'
+
+    def generate():
+        try:
+            if sp is None:
+                yield sse_event({"delta": LOGIN_MESSAGE})
+            else:
+                for piece in chat_replies(user_message, sp, stream=True):
+                    yield sse_event({"delta": piece})
+        except Exception as e:
+            logger.error(f"Error in chat stream route: {e}")
+            yield sse_event({"delta": "An error occurred while processing your request."})
+        finally:
+            # The session was already saved when the headers were sent, save the new state explicitly
+            if session.modified:
+                app.session_interface.save_session(app, session, Response())
+            save_user_state()
+        yield sse_event({}, event="done")
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
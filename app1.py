@@ -1,13 +1,27 @@
 import os
-import json
-from flask import Flask, request, render_template, jsonify
+import secrets
+from flask import Flask, request, render_template, jsonify, session, url_for
 import pandas as pd
-import ast
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics.pairwise import cosine_similarity
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import MemoryCacheHandler
 import logging
+import time
+from functools import cached_property
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from similarity import SimilarityEngine
+from ann_index import IVFIndex
+from feature_store import StringColumn, load_feature_store
+from spotify_clients import SpotifyClientCache, spotify_oauth
+from jobs import JobQueue, JOB_FINISHED_TTL
+from library_store import LibraryStore
+from state_store import StateStore
+from caching import LRUCache
+from track_features import open_track_feature_cache
+from taste import TwoStageRecommender, taste_vectors
+import metrics
+from metrics import span
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -18,124 +32,341 @@ client_secret = os.getenv("CLIENT_SECRET")
 redirect_uri = "http://localhost:5000/callback"
 
 app = Flask(__name__)
+# Signs the session cookie, which says whose library and Spotify client a request uses. Without SECRET_KEY
+# a random key is used, valid until the server restarts.
+app.config['SECRET_KEY'] = os.getenv("SECRET_KEY") or secrets.token_hex(32)
 
 # Initialize Spotipy with user authorization
-sp_oauth = SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri, scope="user-library-read")
+sp_oauth = spotify_oauth(client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri, scope="user-library-read", cache_handler=MemoryCacheHandler())
 
-user_library_combined_df = pd.DataFrame()  # Global variable to store user library combined DataFrame
-X_user_library_scaled = None  # Global variable to store scaled user library features
+LIBRARY_COLUMNS = ['id', 'artist_name', 'track_name', 'added_at']
 fit_columns = []  # Global variable to store columns used during fitting
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Library ingestion settings
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))  # Concurrent Spotify requests during /callback
+SAVED_TRACKS_PAGE_SIZE = 50  # Maximum page size of the saved-tracks endpoint
+AUDIO_FEATURES_BATCH_SIZE = 100  # Maximum number of ids per audio-features call
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "2"))  # Libraries ingested at the same time
+MAX_BATCH_SEEDS = int(os.getenv("MAX_BATCH_SEEDS", "300"))  # Seeds accepted by /recommend/batch
+MAX_BATCH_K = 100  # Recommendations per seed, and radio tracks, /recommend/batch returns at most
+USER_LIBRARY_CACHE_SIZE = int(os.getenv("USER_LIBRARY_CACHE_SIZE", "100"))  # Libraries kept in memory, the rest are reloaded from disk
+LIBRARY_PUBLISH_INTERVAL = float(os.getenv("LIBRARY_PUBLISH_INTERVAL", "1.0"))  # Seconds between partial library snapshots
+
+# Tokens, job status and the latest sync job per user are shared by all worker processes through the state store
+state_store = StateStore()
+metrics.init_app(app, store=state_store)  # GET /metrics, summed over all workers, and the Server-Timing header
+ingest_jobs = JobQueue(workers=INGEST_JOB_WORKERS, store=state_store)
+user_libraries = LRUCache(maxsize=USER_LIBRARY_CACHE_SIZE)  # Spotify user id -> UserLibrary, reloaded when the library store changes
+track_feature_cache = open_track_feature_cache()  # Shared with the crawler in main.py
+
+# Optional approximate nearest-neighbour index over the catalog, enabled by setting ANN_INDEX_PATH
+ANN_INDEX_PATH = os.getenv("ANN_INDEX_PATH")
+ANN_LISTS = int(os.getenv("ANN_LISTS", "0")) or None  # Number of IVF clusters, defaults to sqrt(catalog size)
+ANN_PROBE = int(os.getenv("ANN_PROBE", "8"))  # Clusters scanned per query, higher means better recall
+
+# Configure logging, LOG_LEVEL=DEBUG also logs every upstream HTTP request
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 def get_spotify_auth_url():
     auth_url = sp_oauth.get_authorize_url()
     return auth_url
 
-def get_spotify_token(auth_code):
-    token_info = sp_oauth.get_access_token(auth_code)
-    return token_info['access_token']
-
-def get_user_saved_tracks(sp):
-    results = sp.current_user_saved_tracks(limit=50)
-    saved_tracks = []
-    while results:
-        for item in results['items']:
-            track = item['track']
-            saved_tracks.append(track)
-        if results['next']:
-            results = sp.next(results)
+def get_spotify_token_info(auth_code):
+    return sp_oauth.get_access_token(auth_code, check_cache=False)
+
+def get_pooled_session(pool_size=INGEST_WORKERS):
+    # One keep-alive connection per worker so concurrent calls reuse TLS connections
+    requests_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    requests_session.mount("https://", adapter)
+    return requests_session
+
+# Per-user clients, keyed from the session. Workers that don't have a user's client rebuild it from the stored token.
+spotify_clients = SpotifyClientCache(client_id, client_secret, redirect_uri, scope="user-library-read", store=state_store,
+                                     session_factory=get_pooled_session)
+
+def get_saved_tracks_page(sp, offset=0):
+    return sp.current_user_saved_tracks(limit=SAVED_TRACKS_PAGE_SIZE, offset=offset)
+
+class UserLibrary:
+    # An immutable snapshot of one user's library, replaced as a whole so /chat never sees it half-updated
+    def __init__(self, df, raw, scaled, engine=None):
+        self.version = None  # LibraryStore.version() of the files this snapshot matches
+        self.df = df  # id, artist_name, track_name and added_at per row
+        self.raw = raw  # Unscaled features, as persisted in the library store
+        # Parallel arrays for the query path, so recommendations don't go through pandas
+        self.ids = StringColumn.from_strings(df['id'])
+        self.artist_names = StringColumn.from_strings(df['artist_name'])
+        self.track_names = StringColumn.from_strings(df['track_name'])
+        self.scaled = scaled
+        self.engine = engine if engine is not None else SimilarityEngine(scaled)
+
+    def __len__(self):
+        return len(self.df)
+
+    @cached_property
+    def taste(self):
+        # A few taste vectors for re-ranking catalog recommendations, computed once per snapshot
+        return taste_vectors(self.scaled)
+
+    @cached_property
+    def id_set(self):
+        return set(self.ids.tolist())
+
+    def appended(self, records, raw):
+        # Only the new rows are scaled and normalized, the existing ones are reused as they are
+        scaled = vector_scaler.transform(raw)
+        return UserLibrary(pd.concat([self.df, pd.DataFrame(records, columns=LIBRARY_COLUMNS)], ignore_index=True),
+                           np.concatenate([self.raw, raw]), np.concatenate([self.scaled, scaled]),
+                           self.engine.extended(scaled))
+
+    def without(self, track_ids):
+        keep = ~self.df['id'].isin(track_ids).to_numpy()
+        return UserLibrary(self.df[keep].reset_index(drop=True), self.raw[keep], self.scaled[keep])
+
+def load_user_library(user_id, store):
+    version = store.version()
+    tracks, raw = store.load()
+    library = UserLibrary(pd.DataFrame(tracks, columns=LIBRARY_COLUMNS), raw, vector_scaler.transform(raw))
+    library.version = version
+    user_libraries.set(user_id, library)
+    return library
+
+def publish_user_library(user_id, library, store):
+    # After this process wrote the store itself, so the snapshot isn't reloaded from disk
+    library.version = store.version()
+    user_libraries.set(user_id, library)
+
+def get_user_library(user_id):
+    # In memory if recently used, otherwise from the library store on disk. The sync may run in another
+    # worker process, so the store's version is checked (one stat) and a changed library is reloaded.
+    if user_id is None:
+        return None
+    store = LibraryStore(user_id, fit_columns)
+    library = user_libraries.get(user_id)
+    if library is None or library.version != store.version():
+        library = load_user_library(user_id, store)
+    return library
+
+def library_rows(tracks, features_by_id):
+    # Store records and raw feature rows for the tracks Spotify has a complete analysis for
+    records = []
+    rows = []
+    for track in tracks:
+        features = features_by_id.get(track['id'])
+        if not features or any(features.get(column) is None for column in fit_columns):
+            continue
+        records.append({'id': track['id'], 'artist_name': track['artists'][0]['name'] if len(track['artists']) > 0 else '',
+                        'track_name': track['name'], 'added_at': track['added_at']})
+        rows.append([features[column] for column in fit_columns])
+    return records, np.asarray(rows, dtype=np.float32).reshape(len(rows), len(fit_columns))
+
+def fetch_audio_features(sp, track_ids):
+    features = sp.audio_features(track_ids)
+    if track_feature_cache is not None:
+        track_feature_cache.set_many(dict(zip(track_ids, features)))
+    return features
+
+def get_audio_features(sp, track_ids):
+    # One entry per id, None where there is no analysis. Cached tracks need no API call, the rest are
+    # requested in batches of 100.
+    if track_feature_cache is not None:
+        return track_feature_cache.audio_features(track_ids, sp.audio_features)
+    valid_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id is not None))
+    features_by_id = {}
+    for i in range(0, len(valid_ids), AUDIO_FEATURES_BATCH_SIZE):
+        batch = valid_ids[i:i + AUDIO_FEATURES_BATCH_SIZE]
+        features_by_id.update(zip(batch, sp.audio_features(batch)))
+    return [features_by_id.get(track_id) for track_id in track_ids]
+
+def get_saved_track_ids(sp, total, workers=INGEST_WORKERS):
+    # Every saved track id, without audio features, used to find tracks removed from the library
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = executor.map(lambda offset: get_saved_tracks_page(sp, offset), range(0, total, SAVED_TRACKS_PAGE_SIZE))
+        return {item['track']['id'] for page in pages for item in page['items']}
+
+def sync_user_library(job, sp, user_id, workers=INGEST_WORKERS):
+    # Saved tracks come newest first, so paging stops at the first track older than the last sync and
+    # only new tracks are downloaded. Their audio features are fetched in 100-id batches as ids arrive,
+    # and landed batches are appended to the store and to the in-memory library, so /chat can use them
+    # right away. Removals can't be listed directly: they show up as a saved-track total that doesn't
+    # add up, and only then is the full id list fetched (without audio features) to find them.
+    store = LibraryStore(user_id, fit_columns)
+    library = load_user_library(user_id, store)
+    last_added_at = store.last_added_at
+    known_ids = set(library.df['id'])
+    job.update(stage="fetching tracks", library_size=len(library), tracks_total=None, new_tracks=0,
+               features_cached=0, features_fetched=0, removed_tracks=0)
+
+    new_tracks = []
+    features_by_id = {}
+    newest_added_at = [last_added_at]
+    new_items = 0
+    pending = []
+    feature_batches = {}
+    ready = []
+    features_cached = 0
+    last_published = 0.0
+
+    def publish():
+        nonlocal library
+        records, raw = library_rows(ready, features_by_id)
+        ready.clear()
+        if records:
+            store.append(records, raw)
+            library = library.appended(records, raw)
+            publish_user_library(user_id, library, store)
+            job.update(library_size=len(library))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_feature_batches(full_only):
+            while len(pending) >= AUDIO_FEATURES_BATCH_SIZE or (pending and not full_only):
+                batch = pending[:AUDIO_FEATURES_BATCH_SIZE]
+                del pending[:AUDIO_FEATURES_BATCH_SIZE]
+                feature_batches[executor.submit(fetch_audio_features, sp, [track['id'] for track in batch])] = batch
+
+        def add_page(page):
+            # Returns False once a track from an earlier sync is reached
+            nonlocal new_items, features_cached
+            page_tracks = []
+            reached_synced = False
+            for item in page['items']:
+                if last_added_at is not None and item['added_at'] <= last_added_at:
+                    reached_synced = True
+                    break
+                new_items += 1
+                newest_added_at.append(item['added_at'])
+                track = dict(item['track'], added_at=item['added_at'])
+                # Local files have no id and no audio features, tracks already stored are skipped
+                if track['id'] is None or track['id'] in known_ids:
+                    continue
+                known_ids.add(track['id'])
+                page_tracks.append(track)
+            new_tracks.extend(page_tracks)
+
+            # Tracks analysed before, for another user or by the crawler, need no API call
+            cached = track_feature_cache.get_many([track['id'] for track in page_tracks]) if track_feature_cache is not None else {}
+            for track in page_tracks:
+                if track['id'] in cached:
+                    features_by_id[track['id']] = cached[track['id']]
+                    ready.append(track)
+                else:
+                    pending.append(track)
+            features_cached += len(cached)
+            job.update(new_tracks=len(new_tracks), features_cached=features_cached)
+            submit_feature_batches(full_only=True)
+            return not reached_synced
+
+        first_page = get_saved_tracks_page(sp)
+        total = first_page['total']
+        job.update(tracks_total=total)
+        if last_added_at is None:
+            # First sync, every page is new so the remaining pages are fetched in parallel
+            page_futures = [executor.submit(get_saved_tracks_page, sp, offset)
+                            for offset in range(SAVED_TRACKS_PAGE_SIZE, total, SAVED_TRACKS_PAGE_SIZE)]
+            add_page(first_page)
+            for future in as_completed(page_futures):
+                add_page(future.result())
         else:
-            results = None
-
-    return saved_tracks
-
-def get_token():
-    with open("token.json", "r") as token_file:
-        token_data = json.load(token_file)
-    return token_data["access_token"]
+            page, offset = first_page, 0
+            while add_page(page) and offset + SAVED_TRACKS_PAGE_SIZE < total:
+                offset += SAVED_TRACKS_PAGE_SIZE
+                page = get_saved_tracks_page(sp, offset)
+        submit_feature_batches(full_only=False)
+
+        job.update(stage="fetching audio features")
+        for future in as_completed(list(feature_batches)):
+            batch = feature_batches[future]
+            for track, track_features in zip(batch, future.result()):
+                features_by_id[track['id']] = track_features or {}
+            ready.extend(batch)
+            job.update(features_fetched=len(features_by_id) - features_cached)
+            # Each publish copies the library arrays, so partial updates are rate limited
+            if time.monotonic() - last_published >= LIBRARY_PUBLISH_INTERVAL:
+                publish()
+                last_published = time.monotonic()
+        publish()
+
+    if store.saved_total + new_items != total:
+        job.update(stage="checking for removed tracks")
+        removed = set(library.df['id']) - get_saved_track_ids(sp, total, workers)
+        if removed:
+            library = library.without(removed)
+            store.rewrite(library.df.to_dict('records'), library.raw)
+            publish_user_library(user_id, library, store)
+            job.update(library_size=len(library), removed_tracks=len(removed))
+
+    store.finish_sync(max(filter(None, newest_added_at), default=None), total)
+    publish_user_library(user_id, library, store)
+    if len(library) == 0:
+        raise ValueError("No saved tracks with audio features found.")
 
 @app.route('/')
 def index():
     try:
         auth_url = get_spotify_auth_url()
-        print(f"Auth URL: {auth_url}")  # Print the auth URL for debugging
         return render_template('index.html', auth_url=auth_url)
     except Exception as e:
         logger.error(f"Error in index route: {e}")
-        print(f"Error in index route: {e}")  # Print error message for debugging
         return "An error occurred in the index route."
 
 @app.route('/callback')
 def callback():
-    global user_library_combined_df, X_user_library_scaled, fit_columns
-
-    print("Callback route called")  # Early debug statement
-
     try:
         auth_code = request.args.get('code')
-        print(f"Auth Code: {auth_code}")  # Print auth code for debugging
-        token = get_spotify_token(auth_code)
-        print(f"Token: {token}")  # Print token for debugging
-        with open("token.json", "w") as token_file:
-            json.dump({"access_token": token}, token_file)
-        sp = Spotify(auth=token)
-        saved_tracks = get_user_saved_tracks(sp)
-        print(f"Saved Tracks: {saved_tracks}")  # Print saved tracks for debugging
-        
-        if saved_tracks is None:
-            logger.error("No saved tracks found.")
-            print("No saved tracks found.")  # Print error message for debugging
-            return "No saved tracks found."
-
-        # Prepare user library DataFrame
-        user_library_df = pd.DataFrame(saved_tracks)
-        logger.info(f"User library DataFrame columns: {user_library_df.columns}")
-        print(f"User library DataFrame columns: {user_library_df.columns}")  # Print columns for debugging
-
-        user_library_df['audio_features'] = user_library_df['id'].apply(lambda x: sp.audio_features(x)[0] if x is not None else {})
-        user_library_audio_features_df = pd.json_normalize(user_library_df['audio_features'])
-        user_library_combined_df = pd.concat([user_library_df.drop(columns=['audio_features']), user_library_audio_features_df], axis=1)
-        
-        # Remove duplicate columns
-        user_library_combined_df = user_library_combined_df.loc[:,~user_library_combined_df.columns.duplicated()]
-
-        # Ensure artist_name and track_name are included
-        user_library_combined_df['artist_name'] = user_library_df['artists'].apply(lambda x: x[0]['name'] if len(x) > 0 else '')
-        user_library_combined_df['track_name'] = user_library_df['name']
-
-        # Print column names for inspection
-        logger.info(f"user_library_combined_df columns: {user_library_combined_df.columns}")
-        print(f"user_library_combined_df columns: {user_library_combined_df.columns}")  # Print columns for debugging
-        
-        # Define columns used during fitting
-        fit_columns = list(X.columns)
-        print(f"Fit columns: {fit_columns}")  # Print fit columns for debugging
-        
-        # Ensure consistent column order
-        user_library_combined_df = user_library_combined_df[fit_columns + ['artist_name', 'track_name']]
-        print(f"User library combined DataFrame after reordering: {user_library_combined_df.columns}")  # Print reordered columns for debugging
-
-        # Scale the data
-        X_user_library = user_library_combined_df[fit_columns]
-        X_user_library_scaled = scaler.transform(X_user_library)
-
-        return render_template('chat.html')
+        token_info = get_spotify_token_info(auth_code)
+        # The same client, with its pooled session, serves this user's /chat requests
+        session['spotify_client'] = spotify_clients.add(token_info)
+        sp = spotify_clients.get(session['spotify_client'])
+
+        # The library is synced in the background, /library/status reports how far it has got
+        user_id = sp.current_user()['id']
+        session['spotify_user'] = user_id
+        # A sync already running for this user, in any worker, is reused
+        job = ingest_jobs.get(state_store.get("sync_job", user_id))
+        if job is None or job.done:
+            job = ingest_jobs.submit(sync_user_library, sp, user_id)
+            state_store.set("sync_job", user_id, job.id, ttl=JOB_FINISHED_TTL)
+        session['ingest_job'] = job.id
+        logger.debug(f"Library ingestion job {job.id} for {user_id}")
+
+        # app1 has no streaming endpoint, the chat page posts to the JSON /chat
+        return render_template('chat.html', chat_url=url_for('chat'))
     except Exception as e:
         logger.error(f"Error in callback route: {e}")
-        print(f"Error in callback route: {e}")  # Print error message for debugging
         return "An error occurred in the callback route."
 
+@app.route('/library/status')
+@app.route('/library/status/<job_id>')
+def library_status(job_id=None):
+    job = ingest_jobs.get(job_id or session.get('ingest_job'))
+    if job is None:
+        return jsonify({"error": "No library ingestion job found."}), 404
+    return jsonify(job.status())
+
+def get_recommendation_source():
+    # (engine, tracks) to recommend from: the user library loaded so far, else the catalog index if there is one
+    library = get_user_library(session.get('spotify_user'))
+    if library is not None and len(library) > 0:
+        return library.engine, library
+    if catalog_index is not None:
+        return catalog_index, catalog
+    return None, None
+
+def library_unavailable_message():
+    job = ingest_jobs.get(session.get('ingest_job'))
+    if job is not None and not job.done:
+        return "Your library is still loading, please try again in a moment."
+    return "Your library could not be loaded. Please log in with Spotify again."
+
 @app.route('/chat', methods=['POST'])
 def chat():
-    global user_library_combined_df, X_user_library_scaled, fit_columns
-
     try:
         user_message = request.json.get('message')
-        token = get_token()
-        sp = Spotify(auth=token)
+        sp = spotify_clients.get(session.get('spotify_client'))
+        if sp is None:
+            return jsonify({"message": "Your Spotify session has expired. Please log in with Spotify again."})
         
         # Check if user is asking for a recommendation
         if 'recommend' in user_message.lower():
@@ -144,48 +375,177 @@ def chat():
                 return jsonify({"message": "Please specify a song name after 'recommend'."})
 
             # Search for the song based on user input
-            song = sp.search(q=song_query, type='track', limit=1)['tracks']['items'][0]
-            song_features = sp.audio_features(song['id'])[0]
-            song_features_df = pd.DataFrame([song_features])
-            song_features_df = song_features_df[fit_columns]  # Ensure columns match the order during fit
-            song_features_scaled = scaler.transform(song_features_df)
-
-            # Perform similarity matching against user library
-            recommended_songs = recommend_songs(song_features_scaled[0], X_user_library_scaled, user_library_combined_df, n=10)
-
-            response_message = "Here are some songs you might like:<br>" + "<br>".join([f"{song['artist_name']} - {song['track_name']}" for _, song in recommended_songs.iterrows()])
+            with span("spotify_search"):
+                song = sp.search(q=song_query, type='track', limit=1)['tracks']['items'][0]
+            with span("audio_features"):
+                song_features = get_audio_features(sp, [song['id']])[0]
+            with span("scale"):
+                song_vector = vector_scaler.transform_one(song_features)
+
+            # Perform similarity matching against the user library loaded so far, or against the catalog index before any of it is
+            engine, tracks = get_recommendation_source()
+            if engine is None:
+                return jsonify({"message": library_unavailable_message()})
+            with span("recommend_songs"):
+                recommended_songs = recommend_songs(song_vector, engine, tracks, n=10, seed_id=song['id'])
+
+            response_message = "Here are some songs you might like:<br>" + "<br>".join([f"{artist_name} - {track_name}" for artist_name, track_name in recommended_songs])
+        elif user_message.lower().startswith('discover'):
+            # New music from the whole catalog, re-ranked by the user's taste and without tracks they already have
+            song_query = user_message.lower().replace('discover', '', 1).strip()
+            library = get_user_library(session.get('spotify_user'))
+            taste = library.taste if library is not None else np.empty((0, len(fit_columns)), dtype=np.float32)
+            known_ids = library.id_set if library is not None else set()
+            if song_query:
+                with span("spotify_search"):
+                    song = sp.search(q=song_query, type='track', limit=1)['tracks']['items'][0]
+                with span("audio_features"):
+                    song_features = get_audio_features(sp, [song['id']])[0]
+                with span("scale"):
+                    song_vector = vector_scaler.transform_one(song_features)
+                with span("discover"):
+                    indices, _ = catalog_recommender.recommend(song_vector, taste, k=10, exclude_ids=known_ids | {song['id']})
+            elif len(taste) > 0:
+                with span("discover"):
+                    indices, _ = catalog_recommender.discover(taste, k=10, exclude_ids=known_ids)
+            else:
+                return jsonify({"message": library_unavailable_message()})
+
+            response_message = "Here are some new songs you might like:<br>" + "<br>".join([f"{catalog.artist_names[i]} - {catalog.track_names[i]}" for i in indices])
         else:
-            response_message = "I can help you find song recommendations. Just type 'recommend' followed by a song name."
+            response_message = "I can help you find song recommendations. Just type 'recommend' followed by a song name, or 'discover' for new music."
 
         return jsonify({"message": response_message})
     except Exception as e:
         logger.error(f"Error in chat route: {e}")
-        print(f"Error in chat route: {e}")  # Print error message for debugging
         return jsonify({"message": "An error occurred while processing your request."})
 
-# Data preparation functions from Jupyter Notebook
-def parse_audio_features(audio_features_str):
-    return ast.literal_eval(audio_features_str)
-
-# Load and preprocess initial data
-df = pd.read_csv('song_new.csv')
-df['audio_features'] = df['audio_features'].apply(parse_audio_features)
-audio_features_df = pd.json_normalize(df['audio_features'])
-df_combined = pd.concat([df.drop(columns=['audio_features']), audio_features_df], axis=1)
-X = df_combined.drop(columns=['artist_name', 'track_name', 'track_id', 'id', 'uri', 'track_href', 'analysis_url', 'type'])
-scaler = StandardScaler()
-X_scaled = scaler.fit_transform(X)
-X_scaled = pd.DataFrame(X_scaled, columns=X.columns)
-
-def find_similar_songs(input_song_features, all_songs_features, n=10):
-    similarities = cosine_similarity([input_song_features], all_songs_features)
-    similar_indices = similarities.argsort()[0][-n-1:-1]
-    return similar_indices
-
-def recommend_songs(song_features, X_scaled, df, n=10):
-    similar_songs_indices = find_similar_songs(song_features, X_scaled, n)
-    similar_songs = df.iloc[similar_songs_indices]
-    return similar_songs[['artist_name', 'track_name']]
+def search_track(sp, query):
+    items = sp.search(q=query, type='track', limit=1)['tracks']['items']
+    return items[0] if items else None
+
+def track_results(tracks, indices, scores):
+    # Index -1 pads a query_batch row that found fewer than k tracks
+    return [{"id": str(tracks.ids[i]), "artist_name": str(tracks.artist_names[i]), "track_name": str(tracks.track_names[i]),
+             "score": float(score)} for i, score in zip(indices, scores) if i >= 0]
+
+def batch_count(body, name, default):
+    # A count from the /recommend/batch body, clamped to 1..MAX_BATCH_K, or None if it isn't an integer
+    value = body.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    return max(1, min(value, MAX_BATCH_K))
+
+def string_list(value):
+    # The list of strings in a body field, or None if the field is something else
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        return None
+    return value
+
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_batch():
+    # Recommendations for many seeds in one call. Body: {"track_ids": [...], "queries": [...], "k": 10,
+    # "radio": false, "radio_size": k}. Seed features are fetched in batches of 100 and all seeds are
+    # scored with one query_batch call. With "radio", the tracks closest to the centroid of all seeds
+    # are returned as well.
+    try:
+        sp = spotify_clients.get(session.get('spotify_client'))
+        if sp is None:
+            return jsonify({"error": "Your Spotify session has expired. Please log in with Spotify again."}), 401
+
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return jsonify({"error": "The request body must be a JSON object."}), 400
+        track_ids = string_list(body.get('track_ids'))
+        queries = string_list(body.get('queries'))
+        if track_ids is None or queries is None:
+            return jsonify({"error": "track_ids and queries must be lists of strings."}), 400
+        k = batch_count(body, 'k', 10)
+        radio_size = batch_count(body, 'radio_size', k)
+        if k is None or radio_size is None:
+            return jsonify({"error": "k and radio_size must be integers."}), 400
+        if not track_ids and not queries:
+            return jsonify({"error": "Please provide track_ids or queries."}), 400
+        if len(track_ids) + len(queries) > MAX_BATCH_SEEDS:
+            return jsonify({"error": f"At most {MAX_BATCH_SEEDS} seeds are allowed per request."}), 400
+
+        engine, tracks = get_recommendation_source()
+        if engine is None:
+            return jsonify({"error": library_unavailable_message()}), 503
+
+        # There is no batch search endpoint, queries are resolved with concurrent searches
+        seeds = [{"track_id": track_id} for track_id in track_ids]
+        if queries:
+            with span("spotify_search"), ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+                for query, track in zip(queries, executor.map(lambda query: search_track(sp, query), queries)):
+                    seeds.append({"query": query, "track_id": track['id'] if track else None})
+
+        with span("audio_features"):
+            seed_features = get_audio_features(sp, [seed['track_id'] for seed in seeds])
+        resolved = [i for i, features in enumerate(seed_features)
+                    if features and all(features.get(column) is not None for column in fit_columns)]
+        for seed in seeds:
+            seed['recommendations'] = []
+            seed['found'] = False
+        response = {"results": seeds}
+        if not resolved:
+            return jsonify(response)
+
+        with span("scale"):
+            matrix = vector_scaler.transform([vector_scaler.getter(seed_features[i]) for i in resolved])
+        seed_ids = [seeds[i]['track_id'] for i in resolved]
+        # Library rows of the seeds themselves, so they aren't recommended back
+        seed_rows = tracks.ids.positions(seed_ids)
+        row_of = dict(zip(tracks.ids.take(seed_rows), seed_rows.tolist()))
+        with span("recommend_songs"):
+            indices, scores = engine.query_batch(matrix, k=k, exclude=[row_of.get(track_id) for track_id in seed_ids])
+        for row, i in enumerate(resolved):
+            seeds[i]['found'] = True
+            seeds[i]['recommendations'] = track_results(tracks, indices[row], scores[row])
+
+        if body.get('radio'):
+            centroid = SimilarityEngine._normalize(matrix).mean(axis=0)
+            with span("radio"):
+                radio_indices, radio_scores = engine.query(centroid, k=radio_size, exclude=seed_rows)
+            response['radio'] = track_results(tracks, radio_indices, radio_scores)
+
+        return jsonify(response)
+    except Exception as e:
+        logger.error(f"Error in recommend batch route: {e}")
+        return jsonify({"error": "An error occurred while processing your request."}), 500
+
+# Load the preprocessed catalog, the store is only rebuilt when song_new.csv changes
+catalog = load_feature_store('song_new.csv')
+vector_scaler = catalog.vector_scaler()  # The catalog's StandardScaler parameters as NumPy vectors
+fit_columns = list(catalog.columns)
+
+def load_catalog_index(features, source):
+    # Reuse the saved index only if it was built from this version of the catalog. The index returns row
+    # positions, so a re-crawl with the same row count but a different row order must not reuse it.
+    if os.path.exists(ANN_INDEX_PATH):
+        index = IVFIndex.load(ANN_INDEX_PATH)
+        if index.source == source and len(index) == len(features):
+            index.n_probe = ANN_PROBE
+            return index
+        logger.info("Catalog index is out of date, rebuilding it")
+    index = IVFIndex(n_lists=ANN_LISTS, n_probe=ANN_PROBE).fit(features, source=source)
+    index.save(ANN_INDEX_PATH)
+    return index
+
+# The store directory name carries the CSV fingerprint (see feature_store.csv_fingerprint)
+catalog_index = load_catalog_index(catalog.scaled, os.path.basename(catalog.path)) if ANN_INDEX_PATH else None
+# One normalized copy of the catalog (or its index), shared read-only by every user's 'discover' requests
+catalog_recommender = TwoStageRecommender(catalog_index if catalog_index is not None else SimilarityEngine(catalog.scaled),
+                                          catalog.scaled, catalog.ids)
+
+def recommend_songs(song_vector, engine, tracks, n=10, seed_id=None):
+    # tracks is the user library or the catalog, both keep ids and names in parallel StringColumns.
+    # Returns (artist_name, track_name) pairs, and never the seed track itself.
+    exclude = tracks.ids.positions([seed_id]) if seed_id else None
+    similar_songs_indices, _ = engine.query(song_vector, k=n, exclude=exclude)
+    return [(tracks.artist_names[i], tracks.track_names[i]) for i in similar_songs_indices]
 
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
@@ -0,0 +1,279 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from werkzeug.serving import make_server
+
+from fake_services import FakeServiceConfig, start_fake_openai, start_fake_spotify
+
+# End-to-end benchmark: starts fake Spotify and OpenAI servers, crawls a catalog with main.py, then
+# serves app1.py and app.py on local ports and drives them over HTTP with concurrent virtual users.
+# Every scenario reports p50/p95/p99 latency and requests per second. Runs with the same arguments
+# send the same requests, so results from two commits can be compared (--json, then --compare).
+
+SEED_ARTISTS = ["ACDC", "The Beatles", "Eminem", "Taylor Swift", "Drake", "Travis Scott", "Future"]
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ScenarioResult:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.wall = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0.0, 0.0, 0.0)
+        return {"scenario": self.name, "requests": len(self.latencies), "errors": self.errors,
+                "p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2),
+                "rps": round(len(self.latencies) / self.wall, 2) if self.wall else 0.0}
+
+
+def run_load(name, users, total, request):
+    # request(user, i) sends one request and returns (latency in seconds, ok). Virtual users run
+    # concurrently, each sending every users-th request, so one user never overlaps with itself.
+    result = ScenarioResult(name)
+
+    def run_user(user):
+        for i in range(user, total, users):
+            result.record(*request(user, i))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(run_user, range(users)))
+    result.wall = time.perf_counter() - start
+    return result
+
+
+def timed(function):
+    start = time.perf_counter()
+    try:
+        ok = function()
+    except requests.RequestException:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def reply_ok(response):
+    return response.status_code < 400 and "error occurred" not in response.text and "expired" not in response.text
+
+
+def login_ok(response):
+    # chat.html itself contains "error occurred" (its fetch error message), so only the route's own error counts
+    return response.status_code < 400 and "error occurred in the callback route" not in response.text
+
+
+def serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def configure_environment(args, spotify, openai_server, workdir):
+    # Set before the app modules are imported, they read their settings at import time
+    os.environ.update({
+        "CLIENT_ID": "benchmark", "CLIENT_SECRET": "benchmark", "OPENAI_API_KEY": "benchmark",
+        "SPOTIFY_API_URL": f"{spotify.url}/v1", "SPOTIFY_ACCOUNTS_URL": spotify.url,
+        "OPENAI_API_BASE": f"{openai_server.url}/v1",
+        "TRACK_FEATURES_DB": os.path.join(workdir, "track_features.db"),
+        "FEATURE_STORE_DIR": os.path.join(workdir, "feature_store"),
+        "LIBRARY_STORE_DIR": os.path.join(workdir, "library_store"),
+        "CRAWL_WORKERS": str(args.users),
+    })
+    os.chdir(workdir)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+
+
+def counter_delta(before, after):
+    return {name: after[name] - before.get(name, 0) for name in after if after[name] != before.get(name, 0)}
+
+
+def benchmark_crawl(args, spotify):
+    import main
+    before = dict(spotify.counters)
+    start = time.perf_counter()
+    rows = main.collect_data(SEED_ARTISTS, filename="song_new.csv", workers=args.users, max_depth=args.crawl_depth)
+    wall = time.perf_counter() - start
+    upstream = counter_delta(before, spotify.counters)
+    requests_sent = sum(count for name, count in upstream.items() if name != "429")
+    return {"scenario": "crawl (main.py)", "rows": rows, "wall_s": round(wall, 2),
+            "upstream_requests": requests_sent, "upstream_rps": round(requests_sent / wall, 2)}
+
+
+def benchmark_app1(args, rng):
+    import app1
+    logging.disable(logging.WARNING)
+    server, url = serve(app1.app)
+    sessions = [requests.Session() for _ in range(args.users)]
+    results = []
+
+    def ingest(name):
+        # Login starts the library sync; the request ends when /library/status reports it done
+        def request(user, i):
+            def run():
+                if not login_ok(sessions[user].get(f"{url}/callback", params={"code": f"bench-user-{user}"})):
+                    return False
+                while True:
+                    status = sessions[user].get(f"{url}/library/status").json()
+                    if status.get("done"):
+                        return status.get("error") is None
+                    time.sleep(0.01)
+            return timed(run)
+        return run_load(name, args.users, args.users, request)
+
+    results.append(ingest("app1 ingest, first sync"))
+    results.append(ingest("app1 ingest, resync"))
+
+    queries = [f"song {rng.randrange(args.distinct)}" for _ in range(args.requests)]
+    seed_lists = [[f"t{rng.randrange(args.track_space)}" for _ in range(args.batch_seeds)] for _ in range(args.requests)]
+
+    def chat(message):
+        def request(user, i):
+            return timed(lambda: reply_ok(sessions[user].post(f"{url}/chat", json={"message": message(i)})))
+        return request
+
+    def batch(user, i):
+        body = {"track_ids": seed_lists[i], "k": 10, "radio": True}
+        return timed(lambda: reply_ok(sessions[user].post(f"{url}/recommend/batch", json=body)))
+
+    results.append(run_load("app1 chat: recommend", args.users, args.requests, chat(lambda i: f"recommend {queries[i]}")))
+    results.append(run_load("app1 chat: discover", args.users, args.requests, chat(lambda i: f"discover {queries[i]}")))
+    results.append(run_load(f"app1 recommend/batch ({args.batch_seeds} seeds)", args.users, args.requests, batch))
+    server.shutdown()
+    return results
+
+
+def benchmark_app(args, rng):
+    import app
+    logging.disable(logging.WARNING)
+    server, url = serve(app.app)
+    sessions = [requests.Session() for _ in range(args.users)]
+    for user, session in enumerate(sessions):
+        session.get(f"{url}/callback", params={"code": f"bench-chat-user-{user}"})
+    results = []
+
+    def message_scenario(name, message, reset=True):
+        texts = [message(rng.randrange(args.distinct)) for _ in range(args.requests)]
+
+        def request(user, i):
+            latency, ok = timed(lambda: reply_ok(sessions[user].post(f"{url}/chat", json={"message": texts[i]})))
+            if reset:
+                sessions[user].post(f"{url}/chat", json={"message": "no"})  # Back to the initial state, not timed
+            return latency, ok
+        results.append(run_load(name, args.users, args.requests, request))
+
+    message_scenario("app chat: recommend", lambda q: f"recommend song {q}")
+    message_scenario("app chat: similar artist", lambda q: f"similar artist Artist {q}")
+    message_scenario("app chat: genre", lambda q: f"genre style{q}")
+    message_scenario("app chat: openai", lambda q: f"what is shoegaze number {q}?", reset=False)
+
+    texts = [f"tell me about dream pop number {rng.randrange(args.distinct)}" for _ in range(args.requests)]
+
+    def stream(user, i):
+        def run():
+            response = sessions[user].post(f"{url}/chat/stream", json={"message": texts[i]}, stream=True)
+            body = b"".join(response.iter_content(chunk_size=None))
+            return response.status_code == 200 and b"event: done" in body and b"error occurred" not in body
+        return timed(run)
+    results.append(run_load("app chat/stream: openai", args.users, args.requests, stream))
+    server.shutdown()
+    return results
+
+
+def print_report(crawl, results, previous=None):
+    previous_results = {row["scenario"]: row for row in (previous or {}).get("results", [])}
+    if crawl is not None:
+        print(f"{crawl['scenario']}: {crawl['rows']} rows in {crawl['wall_s']} s, "
+              f"{crawl['upstream_requests']} Spotify requests ({crawl['upstream_rps']}/s)")
+    print(f"{'scenario':<38}{'requests':>9}{'errors':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>9}")
+    for row in results:
+        line = (f"{row['scenario']:<38}{row['requests']:>9}{row['errors']:>7}{row['p50_ms']:>10.1f}"
+                f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['rps']:>9.1f}")
+        before = previous_results.get(row["scenario"])
+        if before and before["p50_ms"]:
+            line += f"   p50 {100 * (row['p50_ms'] / before['p50_ms'] - 1):+.0f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark main.py, app1.py and app.py against local fake Spotify and OpenAI servers.")
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--requests", type=int, default=200, help="requests per chat scenario")
+    parser.add_argument("--distinct", type=int, default=50, help="distinct queries per scenario, fewer means more cache hits")
+    parser.add_argument("--spotify-latency", type=float, default=50, help="milliseconds per fake Spotify response")
+    parser.add_argument("--openai-latency", type=float, default=300, help="milliseconds before the first fake OpenAI token")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of upstream requests answered with HTTP 429")
+    parser.add_argument("--retry-after", type=int, default=0, help="seconds sent in Retry-After with a 429")
+    parser.add_argument("--library-size", type=int, default=500, help="saved tracks per fake user")
+    parser.add_argument("--track-space", type=int, default=50_000, help="distinct track ids in the fake catalog")
+    parser.add_argument("--batch-seeds", type=int, default=50, help="seed tracks per /recommend/batch request")
+    parser.add_argument("--crawl-depth", type=int, default=1)
+    parser.add_argument("--apps", nargs="+", default=["crawl", "app1", "app"], choices=["crawl", "app1", "app"])
+    parser.add_argument("--workdir", help="directory for the generated catalog and stores (default: a new temp dir)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare p50 latency against")
+    parser.add_argument("--verbose", action="store_true", help="show the apps' own output")
+    args = parser.parse_args()
+    # Paths are resolved before the benchmark changes into its work directory
+    args.json = args.json and os.path.abspath(args.json)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    config = FakeServiceConfig(latency=args.spotify_latency / 1000, rate_limit=args.rate_limit,
+                               retry_after=args.retry_after, track_space=args.track_space,
+                               library_size=args.library_size, openai_latency=args.openai_latency / 1000, seed=args.seed)
+    spotify = start_fake_spotify(config)
+    openai_server = start_fake_openai(config)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="song-bot-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(args, spotify, openai_server, workdir)
+    rng = random.Random(args.seed)
+
+    crawl = None
+    results = []
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        if "crawl" in args.apps or not os.path.exists("song_new.csv"):
+            crawl = benchmark_crawl(args, spotify)
+        if "app1" in args.apps:
+            results.extend(benchmark_app1(args, rng))
+        if "app" in args.apps:
+            results.extend(benchmark_app(args, rng))
+
+    summaries = [result.summary() for result in results]
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+    print(f"Work directory: {workdir}")
+    print_report(crawl, summaries, previous)
+    print(f"Fake Spotify requests: {json.dumps(spotify.counters, sort_keys=True)}")
+    print(f"Fake OpenAI requests: {json.dumps(openai_server.counters, sort_keys=True)}")
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump({"config": vars(args), "crawl": crawl, "results": summaries,
+                       "upstream": {"spotify": spotify.counters, "openai": openai_server.counters}}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
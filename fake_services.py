@@ -0,0 +1,241 @@
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-ins for the Spotify Web API, the Spotify accounts service and the OpenAI chat API, used by
+# e2e_benchmark.py. Every response is derived from the request (same query, same tracks), so runs are
+# comparable. Latency and HTTP 429 responses are injected according to FakeServiceConfig.
+
+AUDIO_FEATURE_KEYS = ["danceability", "energy", "key", "loudness", "mode", "speechiness", "acousticness",
+                      "instrumentalness", "liveness", "valence", "tempo"]
+
+
+class FakeServiceConfig:
+    def __init__(self, latency=0.05, jitter=0.2, rate_limit=0.0, retry_after=0, track_space=50_000,
+                 artist_space=5_000, library_size=500, openai_latency=0.3, token_delay=0.005, seed=0):
+        self.latency = latency  # Seconds added to every Spotify response
+        self.jitter = jitter  # Latency varies by up to this fraction either way
+        self.rate_limit = rate_limit  # Fraction of Spotify requests answered with HTTP 429
+        self.retry_after = retry_after  # Whole seconds sent in Retry-After with a 429
+        self.track_space = track_space  # Distinct track ids the fake catalog hands out
+        self.artist_space = artist_space
+        self.library_size = library_size  # Saved tracks per fake user
+        self.openai_latency = openai_latency  # Seconds before the first OpenAI token
+        self.token_delay = token_delay  # Seconds between streamed OpenAI tokens
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, base):
+        with self.lock:
+            factor = 1 + self.jitter * (2 * self.random.random() - 1)
+        time.sleep(max(0.0, base * factor))
+
+    def rate_limited(self):
+        with self.lock:
+            return self.random.random() < self.rate_limit
+
+
+def stable_hash(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def fake_track(n, config):
+    artist = n % config.artist_space
+    return {"id": f"t{n}", "name": f"Track {n}", "uri": f"spotify:track:t{n}",
+            "artists": [{"id": f"a{artist}", "name": f"Artist {artist}"}]}
+
+
+def fake_artist(n):
+    return {"id": f"a{n}", "name": f"Artist {n}", "genres": []}
+
+
+def fake_audio_features(track_id):
+    rng = random.Random(track_id)
+    features = {key: rng.random() for key in AUDIO_FEATURE_KEYS}
+    features.update(key=rng.randrange(12), mode=rng.randrange(2), loudness=-30 * rng.random(),
+                    tempo=60 + 120 * rng.random(), type="audio_features", id=track_id,
+                    uri=f"spotify:track:{track_id}", track_href=f"https://api.spotify.com/v1/tracks/{track_id}",
+                    analysis_url=f"https://api.spotify.com/v1/audio-analysis/{track_id}",
+                    duration_ms=rng.randrange(120_000, 360_000), time_signature=4)
+    return features
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real services
+    # Headers and body go out in separate writes. With Nagle's algorithm on, the body then waits for the
+    # client's delayed ACK (~40 ms) on every keep-alive request, which would swamp the configured latency.
+    disable_nagle_algorithm = True
+    config = None
+    counters = None
+    counters_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def count(self, name):
+        with self.counters_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+class FakeSpotifyHandler(FakeHandler):
+    # Accounts (/api/token) and Web API (/v1/...) on one server
+
+    def do_POST(self):
+        body = parse_qs(self.read_body().decode("utf-8"))
+        if urlparse(self.path).path != "/api/token":
+            return self.send_json(404, {"error": "not found"})
+        self.count("token")
+        # The authorization code becomes the user, so every benchmark login is a different Spotify user
+        user = (body.get("code") or body.get("refresh_token") or ["client"])[0]
+        self.send_json(200, {"access_token": f"token-{user}", "token_type": "Bearer", "expires_in": 3600,
+                             "refresh_token": user, "scope": "user-library-read"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip("/")
+        config = self.config
+        if config.rate_limited():
+            self.count("429")
+            return self.send_json(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                                  {"Retry-After": str(config.retry_after)})
+        config.delay(config.latency)
+
+        limit = int(query.get("limit", 20))
+        offset = int(query.get("offset", 0))
+        if path == "/v1/me":
+            self.count("me")
+            return self.send_json(200, {"id": self.user(), "display_name": self.user()})
+        if path == "/v1/me/tracks":
+            self.count("saved_tracks")
+            return self.send_json(200, self.saved_tracks(limit, offset))
+        if path == "/v1/search":
+            self.count("search")
+            return self.send_json(200, self.search(query["q"], query.get("type", "track"), limit, offset))
+        if path == "/v1/recommendations":
+            self.count("recommendations")
+            seed = stable_hash(query.get("seed_tracks", ""))
+            tracks = [fake_track((seed + 7919 * i) % config.track_space, config) for i in range(limit)]
+            return self.send_json(200, {"tracks": tracks, "seeds": []})
+        if path == "/v1/audio-features":
+            self.count("audio_features")
+            ids = query.get("ids", "").split(",")
+            return self.send_json(200, {"audio_features": [fake_audio_features(track_id) for track_id in ids]})
+        match = re.fullmatch(r"/v1/artists/a?(\d+)/(related-artists|top-tracks)", path)
+        if match:
+            artist = int(match.group(1))
+            if match.group(2) == "related-artists":
+                self.count("related_artists")
+                related = [fake_artist((artist * 31 + i * 97) % config.artist_space) for i in range(1, 21)]
+                return self.send_json(200, {"artists": related})
+            self.count("top_tracks")
+            tracks = [fake_track(artist + config.artist_space * i, config) for i in range(10)]
+            return self.send_json(200, {"tracks": tracks})
+        self.send_json(404, {"error": {"status": 404, "message": "Service not found"}})
+
+    def user(self):
+        return self.headers.get("Authorization", "").replace("Bearer token-", "") or "anonymous"
+
+    def saved_tracks(self, limit, offset):
+        config = self.config
+        user_seed = stable_hash(self.user())
+        items = []
+        for i in range(offset, min(offset + limit, config.library_size)):
+            n = (user_seed + 104729 * i) % config.track_space
+            added_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1_700_000_000 - 3600 * i))
+            items.append({"added_at": added_at, "track": fake_track(n, config)})
+        return {"items": items, "total": config.library_size, "limit": limit, "offset": offset}
+
+    def search(self, q, search_type, limit, offset):
+        config = self.config
+        seed = stable_hash(q)
+        if search_type == "artist":
+            # Artist searches resolve to one artist per name, like a search for an exact artist name
+            artists = [fake_artist((seed + i) % config.artist_space) for i in range(offset, offset + limit)]
+            return {"artists": {"items": artists, "total": 1000}}
+        tracks = [fake_track((seed + 7919 * i) % config.track_space, config) for i in range(offset, offset + limit)]
+        return {"tracks": {"items": tracks, "total": 1000}}
+
+
+class FakeOpenAIHandler(FakeHandler):
+    # POST /v1/chat/completions, plain or streamed
+
+    def do_POST(self):
+        body = json.loads(self.read_body() or b"{}")
+        if urlparse(self.path).path.rstrip("/") != "/v1/chat/completions":
+            return self.send_json(404, {"error": {"message": "not found"}})
+        self.count("chat_completions")
+        config = self.config
+        if config.rate_limited():
+            self.count("429")
+            return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                  {"Retry-After": str(config.retry_after)})
+        question = body["messages"][-1]["content"]
+        words = f"Here is a short answer about {question}.".split(" ")
+        config.delay(config.openai_latency)
+
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": " ".join(words)}
+            return self.send_json(200, {"id": "chatcmpl-bench", "object": "chat.completion", "model": body.get("model"),
+                                        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}]})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i, word in enumerate(words):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(config.token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class FakeServer:
+    def __init__(self, handler, config, port=0):
+        self.counters = {}
+        handler_class = type(handler.__name__, (handler,), {"config": config, "counters": self.counters})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=handler.__name__, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_fake_spotify(config, port=0):
+    return FakeServer(FakeSpotifyHandler, config, port).start()
+
+
+def start_fake_openai(config, port=0):
+    return FakeServer(FakeOpenAIHandler, config, port).start()
@@ -0,0 +1,194 @@
+import ast
+import hashlib
+import json
+import operator
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+# Compiled, memory-mapped copy of the catalog CSV.
+# Parsing song_new.csv means an ast.literal_eval per row plus json_normalize and a scaler fit, so
+# the result is written once as .npy arrays and every later boot just maps those files. Workers
+# mapping the same files share their pages through the OS page cache.
+
+FEATURE_STORE_DIR = os.getenv("FEATURE_STORE_DIR", "feature_store")
+FEATURE_STORE_FORMAT = 2  # Part of the store's directory name, stores in an older layout are rebuilt
+NON_FEATURE_COLUMNS = ['artist_name', 'track_name', 'track_id', 'id', 'uri', 'track_href', 'analysis_url', 'type']
+
+
+def parse_audio_features(audio_features_str):
+    return ast.literal_eval(audio_features_str)
+
+
+def csv_fingerprint(csv_path):
+    # Size and modification time identify a CSV version without reading the whole file
+    stat = os.stat(csv_path)
+    key = f"{os.path.abspath(csv_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class VectorScaler:
+    # StandardScaler.transform without pandas or sklearn validation, for per-request feature vectors.
+    # Features come in as API dicts (or raw rows in column order) and are scaled with plain NumPy.
+
+    def __init__(self, columns, mean, scale):
+        self.columns = list(columns)
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.getter = operator.itemgetter(*self.columns)
+
+    def transform_one(self, features):
+        # One audio-features dict to a scaled float32 vector in column order
+        return (np.array(self.getter(features), dtype=np.float32) - self.mean) / self.scale
+
+    def transform(self, rows):
+        # Raw feature rows, shape (n, len(columns)), to scaled float32 rows
+        return (np.asarray(rows, dtype=np.float32).reshape(-1, len(self.columns)) - self.mean) / self.scale
+
+
+def _isin_few(strings, wanted):
+    # np.isin sorts the whole column once there are more than a handful of values. Looking every row up in
+    # the few sorted values is an order of magnitude faster on a large catalog: a row matches when its left
+    # and right insertion points differ.
+    wanted = np.unique(np.array(wanted, dtype=strings.dtype))
+    return np.searchsorted(wanted, strings, 'left') != np.searchsorted(wanted, strings, 'right')
+
+
+class StringColumn:
+    # Strings as one UTF-8 blob plus row offsets. NumPy's str dtype is UTF-32 padded to the longest string,
+    # so one 200-character title would cost every row 800 bytes. Here a row costs its UTF-8 length plus an
+    # 8-byte offset, and only the rows that are read get decoded.
+
+    def __init__(self, data, offsets):
+        self.data = data  # uint8
+        self.offsets = offsets  # int64, one more than there are rows
+        # With equal-length strings (Spotify ids) the blob doubles as a fixed-width bytes array for lookups
+        lengths = np.diff(offsets)
+        self.width = int(lengths[0]) if len(lengths) and lengths[0] > 0 and np.all(lengths == lengths[0]) else None
+
+    @classmethod
+    def from_strings(cls, values):
+        encoded = [str(value).encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def save(self, path, name):
+        np.save(os.path.join(path, f"{name}.utf8.npy"), self.data)
+        np.save(os.path.join(path, f"{name}.offsets.npy"), self.offsets)
+
+    @classmethod
+    def load(cls, path, name):
+        return cls(np.load(os.path.join(path, f"{name}.utf8.npy"), mmap_mode="r"),
+                   np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+    def tolist(self):
+        return self.take(range(len(self)))
+
+    def positions(self, values):
+        # Rows holding any of `values`, in row order. Values are grouped by byte length and only compared
+        # with rows of that length, as fixed-width bytes arrays, so nothing is decoded.
+        by_length = {}
+        for value in values:
+            encoded = str(value).encode("utf-8")
+            by_length.setdefault(len(encoded), []).append(encoded)
+        lengths = None
+        found = []
+        for length, wanted in by_length.items():
+            if length == self.width:
+                found.append(np.flatnonzero(_isin_few(self.data.view(f"S{length}"), wanted)))
+                continue
+            if lengths is None:
+                lengths = np.diff(self.offsets)
+            rows = np.flatnonzero(lengths == length)
+            if length == 0 or len(rows) == 0:
+                found.append(rows)
+                continue
+            strings = self.data[self.offsets[rows, None] + np.arange(length)].view(f"S{length}").ravel()
+            found.append(rows[_isin_few(strings, wanted)])
+        return np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.intp)
+
+
+class FeatureStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as meta_file:
+            meta = json.load(meta_file)
+        self.columns = meta["columns"]
+        self.mean = np.asarray(meta["mean"])
+        self.scale = np.asarray(meta["scale"])
+        self.n_samples = meta["n_samples"]
+
+        self.scaled = np.load(os.path.join(path, "scaled.npy"), mmap_mode="r")
+        self.ids = StringColumn.load(path, "ids")
+        self.artist_names = StringColumn.load(path, "artist_names")
+        self.track_names = StringColumn.load(path, "track_names")
+
+    def __len__(self):
+        return self.scaled.shape[0]
+
+    def vector_scaler(self):
+        return VectorScaler(self.columns, self.mean, self.scale)
+
+
+def build_feature_store(csv_path, path):
+    df = pd.read_csv(csv_path)
+    if 'audio_features' in df.columns:
+        # Older crawls stored the audio features as one stringified dict per row
+        df['audio_features'] = df['audio_features'].apply(parse_audio_features)
+        audio_features_df = pd.json_normalize(df['audio_features'])
+        df_combined = pd.concat([df.drop(columns=['audio_features']), audio_features_df], axis=1)
+    else:
+        # Tracks the API returned no audio features for have empty feature columns
+        feature_columns = [column for column in df.columns if column not in NON_FEATURE_COLUMNS]
+        df_combined = df.dropna(subset=feature_columns).reset_index(drop=True)
+    X = df_combined.drop(columns=NON_FEATURE_COLUMNS)
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(X)
+
+    # Write into a private directory first so other workers never see a half-built store
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "scaled.npy"), X_scaled.astype(np.float32))
+    for name, column in (("ids", 'id'), ("artist_names", 'artist_name'), ("track_names", 'track_name')):
+        StringColumn.from_strings(df_combined[column].astype(str)).save(tmp_path, name)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as meta_file:
+        json.dump({
+            "source": os.path.abspath(csv_path),
+            "columns": list(X.columns),
+            "mean": scaler.mean_.tolist(),
+            "scale": scaler.scale_.tolist(),
+            "n_samples": int(scaler.n_samples_seen_),
+        }, meta_file)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another worker finished the same build first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_feature_store(csv_path, store_dir=FEATURE_STORE_DIR):
+    # Returns the store for the current version of csv_path, building it if the CSV changed
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    path = os.path.join(store_dir, f"{name}-v{FEATURE_STORE_FORMAT}-{csv_fingerprint(csv_path)}")
+    if not os.path.exists(path):
+        os.makedirs(store_dir, exist_ok=True)
+        build_feature_store(csv_path, path)
+        # Stores for older versions of the CSV are no longer needed
+        for entry in os.listdir(store_dir):
+            entry_path = os.path.join(store_dir, entry)
+            if entry.startswith(f"{name}-") and entry_path != path and ".tmp-" not in entry:
+                shutil.rmtree(entry_path, ignore_errors=True)
+    return FeatureStore(path)
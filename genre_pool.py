@@ -0,0 +1,110 @@
+import os
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from caching import LRUCache
+
+GENRE_POOL_SIZE = int(os.getenv("GENRE_POOL_SIZE", "200"))  # Candidates kept per genre
+GENRE_POOL_LOW_WATER = int(os.getenv("GENRE_POOL_LOW_WATER", "50"))  # Refill below this many candidates
+GENRE_POOL_MAX_GENRES = int(os.getenv("GENRE_POOL_MAX_GENRES", "200"))
+SEARCH_PAGE_SIZE = 50  # Maximum page size of the search endpoint
+SEARCH_MAX_OFFSET = 1000  # Spotify search does not page past this offset
+
+
+class GenrePool:
+    def __init__(self, genre):
+        self.genre = genre
+        self.tracks = deque()
+        self.track_ids = set()
+        self.next_offset = 0
+        self.refilling = False
+        self.lock = threading.Lock()
+
+
+class GenrePools:
+    # Per-genre candidate tracks shared by all users. Served tracks leave the pool, and the pool is
+    # refilled in the background by paging further through the genre's search results (wrapping back
+    # to offset 0 at the end), so a genre request is answered from memory and keeps finding new tracks.
+
+    def __init__(self, size=GENRE_POOL_SIZE, low_water=GENRE_POOL_LOW_WATER, max_genres=GENRE_POOL_MAX_GENRES):
+        self.size = size
+        self.low_water = low_water
+        self.pools = LRUCache(maxsize=max_genres)
+        self.pools_lock = threading.Lock()
+        self.refiller = ThreadPoolExecutor(max_workers=2, thread_name_prefix="genre-pool-refill")
+
+    def pool(self, genre):
+        with self.pools_lock:
+            pool = self.pools.get(genre)
+            if pool is None:
+                pool = GenrePool(genre)
+                self.pools.set(genre, pool)
+            return pool
+
+    def fill(self, pool, fetch_page, pages=1):
+        # fetch_page(offset) returns one page of search results
+        for _ in range(pages):
+            with pool.lock:
+                offset = pool.next_offset
+            tracks = fetch_page(offset)
+            random.shuffle(tracks)  # Different users and requests see a different order
+            with pool.lock:
+                pool.next_offset = offset + SEARCH_PAGE_SIZE
+                if not tracks or pool.next_offset + SEARCH_PAGE_SIZE > SEARCH_MAX_OFFSET:
+                    pool.next_offset = 0
+                for track in tracks:
+                    if track['id'] not in pool.track_ids:
+                        pool.track_ids.add(track['id'])
+                        pool.tracks.append(track)
+                # Candidates nobody wanted are at the front, drop them once the pool is over size
+                while len(pool.tracks) > 2 * self.size:
+                    pool.track_ids.discard(pool.tracks.popleft()['id'])
+                if len(pool.tracks) >= self.size:
+                    break
+
+    def refill_in_background(self, pool, fetch_page):
+        with pool.lock:
+            if pool.refilling:
+                return
+            pool.refilling = True
+
+        def run():
+            try:
+                self.fill(pool, fetch_page, pages=max(1, self.size // SEARCH_PAGE_SIZE))
+            except Exception:
+                pass  # The next request retries
+            finally:
+                with pool.lock:
+                    pool.refilling = False
+
+        self.refiller.submit(run)
+
+    def take(self, genre, fetch_page, count=5, accept=None):
+        # Up to `count` tracks by different artists for which accept(track) is true
+        pool = self.pool(genre)
+        if len(pool.tracks) < count:
+            self.fill(pool, fetch_page)  # Cold pool, this request waits for the first page
+
+        selected = []
+        rejected = []
+        artists = set()
+        with pool.lock:
+            for _ in range(len(pool.tracks)):
+                if len(selected) == count:
+                    break
+                track = pool.tracks.popleft()
+                artist_name = track['artists'][0]['name']
+                if artist_name in artists or (accept is not None and not accept(track)):
+                    rejected.append(track)
+                    continue
+                artists.add(artist_name)
+                selected.append(track)
+                pool.track_ids.discard(track['id'])
+            # Tracks this user can't use stay available for others, at the front
+            pool.tracks.extendleft(reversed(rejected))
+
+        if len(pool.tracks) < self.low_water or len(selected) < count:
+            self.refill_in_background(pool, fetch_page)
+        return selected
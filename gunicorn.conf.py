@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+# Production server for app.py or app1.py:
+#   gunicorn -c gunicorn.conf.py app:app
+# Every worker runs a pool of threads, since most of a request is spent waiting on Spotify or OpenAI.
+# The app is imported once in the master before the workers are forked, so the spaCy model and the
+# catalog arrays are loaded once and shared copy-on-write. Per-user state is in the SQLite state store
+# (STATE_DB), so any worker can serve any request.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+preload_app = True
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))  # Seconds, above OPENAI_TIMEOUT so slow upstream calls fail first
+keepalive = 5
+
+# Load the spaCy model in the master, a background loader thread would not survive the fork
+os.environ.setdefault("SPACY_PRELOAD", "1")
@@ -0,0 +1,105 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from caching import LRUCache
+
+JOB_RUNNING_TTL = 300  # Seconds a stored running job stays visible without an update, in case its worker died
+JOB_FINISHED_TTL = 3600  # Seconds a finished job's status stays visible to other workers
+
+
+class Job:
+    # A background task with a stage name and free-form progress counters that status() reports
+
+    def __init__(self, on_update=None):
+        self.id = uuid.uuid4().hex
+        self.stage = "queued"
+        self.progress = {}
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.lock = threading.Lock()
+        self.on_update = on_update  # Called with the job after every change
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def update(self, stage=None, **progress):
+        with self.lock:
+            if stage is not None:
+                self.stage = stage
+            self.progress.update(progress)
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def status(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "stage": self.stage,
+                "done": self.done,
+                "error": self.error,
+                "elapsed": (self.finished_at or time.time()) - self.created_at,
+                **self.progress,
+            }
+
+
+class StoredJob:
+    # Read-only view of a job that runs in another worker process, from its last stored status
+
+    def __init__(self, status):
+        self.id = status["id"]
+        self.done = status["done"]
+        self.error = status["error"]
+        self._status = status
+
+    def status(self):
+        return dict(self._status)
+
+
+class JobQueue:
+    # Runs jobs on a bounded thread pool and remembers the most recent ones for status lookups.
+    # With a state store, job status is also written there so any worker can report it.
+
+    namespace = "job"
+
+    def __init__(self, workers=4, history=1000, store=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.jobs = LRUCache(maxsize=history)
+        self.store = store
+
+    def save(self, job):
+        status = job.status()
+        self.store.set(self.namespace, job.id, status, ttl=JOB_FINISHED_TTL if status["done"] else JOB_RUNNING_TTL)
+
+    def submit(self, function, *args, **kwargs):
+        # function is called as function(job, *args, **kwargs)
+        job = Job(on_update=self.save if self.store is not None else None)
+        self.jobs.set(job.id, job)
+
+        def run():
+            job.update(stage="running")
+            try:
+                function(job, *args, **kwargs)
+            except Exception as e:
+                job.error = str(e)
+                job.finished_at = time.time()
+                job.update(stage="failed")
+            else:
+                job.finished_at = time.time()
+                job.update(stage="done")
+
+        job.update()
+        self.executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        if job_id is None:
+            return None
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            status = self.store.get(self.namespace, job_id)
+            job = StoredJob(status) if status is not None else None
+        return job
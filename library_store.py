@@ -0,0 +1,102 @@
+import json
+import os
+import re
+import numpy as np
+
+# Per-user copy of a Spotify library, so a login only downloads what changed since the last sync.
+# Each user gets a directory with:
+#   features.f32  raw (unscaled) audio features, one float32 row per track, appended to
+#   tracks.jsonl  one {"id", "artist_name", "track_name", "added_at"} line per row, appended to
+#   meta.json     feature columns, file sizes, newest added_at and the saved-track total at the last sync
+# meta.json is rewritten last, so rows from an interrupted append are cut off on the next load.
+# Raw features are stored instead of scaled ones so the files stay valid when the catalog scaler changes.
+
+LIBRARY_STORE_DIR = os.getenv("LIBRARY_STORE_DIR", "library_store")
+
+
+class LibraryStore:
+    def __init__(self, user_id, columns, root=LIBRARY_STORE_DIR):
+        self.path = os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]", "_", user_id))
+        self.columns = list(columns)
+        self.meta = self._empty_meta()
+
+    def _empty_meta(self):
+        return {"columns": self.columns, "n_rows": 0, "features_bytes": 0, "tracks_bytes": 0,
+                "last_added_at": None, "saved_total": 0}
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def last_added_at(self):
+        return self.meta["last_added_at"]
+
+    @property
+    def saved_total(self):
+        return self.meta["saved_total"]
+
+    def load(self):
+        # Returns (tracks, features) as stored, or ([], empty array) if there is no usable store
+        features = np.empty((0, len(self.columns)), dtype=np.float32)
+        try:
+            with open(self._file("meta.json"), "r") as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return [], features
+        if meta["columns"] != self.columns:
+            return [], features  # Different feature layout, start over
+        try:
+            with open(self._file("features.f32"), "rb") as features_file:
+                data = features_file.read(meta["features_bytes"])
+            with open(self._file("tracks.jsonl"), "rb") as tracks_file:
+                lines = tracks_file.read(meta["tracks_bytes"]).splitlines()
+        except OSError:
+            return [], features
+        if len(data) != meta["features_bytes"] or len(lines) != meta["n_rows"]:
+            return [], features  # Files are shorter than the metadata says, resync from scratch
+
+        self.meta = meta
+        tracks = [json.loads(line) for line in lines]
+        features = np.frombuffer(data, dtype=np.float32).reshape(meta["n_rows"], len(self.columns))
+        return tracks, features
+
+    def version(self):
+        # Changes whenever meta.json is replaced, so a process can tell its loaded copy is out of date
+        try:
+            stat = os.stat(self._file("meta.json"))
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _write_meta(self):
+        tmp_path = self._file(f"meta.json.tmp-{os.getpid()}")
+        with open(tmp_path, "w") as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(tmp_path, self._file("meta.json"))
+
+    def append(self, tracks, features):
+        # tracks are dicts with id, artist_name, track_name and added_at, features the matching raw rows
+        os.makedirs(self.path, exist_ok=True)
+        features_bytes = np.ascontiguousarray(features, dtype=np.float32).tobytes()
+        tracks_bytes = "".join(json.dumps(track) + "\n" for track in tracks).encode("utf-8")
+        for name, offset, data in (("features.f32", self.meta["features_bytes"], features_bytes),
+                                   ("tracks.jsonl", self.meta["tracks_bytes"], tracks_bytes)):
+            with open(self._file(name), "ab") as store_file:
+                store_file.truncate(offset)  # Drop anything left over from an interrupted append
+                store_file.write(data)
+        self.meta["n_rows"] += len(tracks)
+        self.meta["features_bytes"] += len(features_bytes)
+        self.meta["tracks_bytes"] += len(tracks_bytes)
+        self._write_meta()
+
+    def rewrite(self, tracks, features):
+        # Replaces all rows, used when tracks were removed from the library
+        self.meta.update(n_rows=0, features_bytes=0, tracks_bytes=0)
+        self.append(tracks, features)
+
+    def finish_sync(self, last_added_at, saved_total):
+        # Only recorded once every new track is stored, so an interrupted sync is picked up again next time
+        os.makedirs(self.path, exist_ok=True)
+        self.meta["last_added_at"] = last_added_at
+        self.meta["saved_total"] = saved_total
+        self._write_meta()
@@ -2,144 +2,371 @@ import json
 from dotenv import load_dotenv
 import os
 import base64
-from requests import post, get
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
 import csv
+from track_features import open_track_feature_cache
 
 load_dotenv()
 
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET")
 
-def get_token():
+# Base URLs can point at a local fake Spotify server for testing
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+
+CRAWL_WORKERS = int(os.getenv("CRAWL_WORKERS", "8"))  # Concurrent requests while crawling
+MAX_RETRIES = 5  # Attempts per request on HTTP 429 or an expired token
+REQUEST_TIMEOUT = 30  # Seconds
+TOKEN_EXPIRY_MARGIN = 60  # Refresh the token this many seconds before it expires
+CHECKPOINT_INTERVAL = 5  # Seconds between crawl checkpoints
+CRAWL_DEPTH = int(os.getenv("CRAWL_DEPTH", "1"))  # Related-artist hops to expand from each seed artist
+CRAWL_ARTIST_BUDGET = int(os.getenv("CRAWL_ARTIST_BUDGET", "0"))  # Stop adding artists after this many, 0 means no limit
+AUDIO_FEATURES_BATCH_SIZE = 100  # Maximum number of ids per audio-features call
+MAX_TASK_ATTEMPTS = 3  # Times a crawl task that hit a transient error is run before it is left for the next run
+
+# Audio features are written as real CSV columns, in the order the API returns them
+AUDIO_FEATURE_COLUMNS = ["danceability", "energy", "key", "loudness", "mode", "speechiness", "acousticness",
+                         "instrumentalness", "liveness", "valence", "tempo", "type", "id", "uri", "track_href",
+                         "analysis_url", "duration_ms", "time_signature"]
+
+track_feature_cache = open_track_feature_cache()  # Shared with app1.py, None when TRACK_FEATURES_DB is empty
+
+class TransientSpotifyError(Exception):
+    # A failure that may go away when the request is repeated: rate limits, server errors, token trouble
+    pass
+
+def is_transient(error):
+    return isinstance(error, (TransientSpotifyError, requests.ConnectionError, requests.Timeout))
+
+def get_token_info(session=requests):
     auth_string = client_id + ":" + client_secret
     auth_bytes = auth_string.encode("utf-8")
     auth_base64 = str(base64.b64encode(auth_bytes), "utf-8")
 
-    url = "https://accounts.spotify.com/api/token"
+    url = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
     headers = {
         "Authorization": "Basic " + auth_base64,
         "Content-Type": "application/x-www-form-urlencoded"
     }
     data = {"grant_type": "client_credentials"}
-    result = post(url, headers=headers, data=data)
+    result = session.post(url, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
     
     if result.status_code != 200:
         print("Error:", result.content.decode("utf-8"))
+        if result.status_code == 429 or result.status_code >= 500:
+            raise TransientSpotifyError("Failed to retrieve token")
         raise Exception("Failed to retrieve token")
 
-    json_result = json.loads(result.content)
-    token = json_result["access_token"]
-    return token
+    return json.loads(result.content)
+
+def get_token():
+    return get_token_info()["access_token"]
 
 def get_auth_header(token):
     return {"Authorization": "Bearer " + token}
 
-def search_for_artist(token, artist_name):
-    url = "https://api.spotify.com/v1/search"
-    headers = get_auth_header(token)
-    query = f"?q={artist_name}&type=artist&limit=1"
-     
-    query_url = url + query
-    result = get(query_url, headers=headers)
-    
-    if result.status_code != 200:
-        print("Error:", result.content.decode("utf-8"))
-        raise Exception("Failed to search for artist")
+class SpotifyClient:
+    # Thread-safe Web API client for the crawler: one pooled session, a client-credentials
+    # token that is refreshed when it expires, and a shared pause after HTTP 429 responses.
 
-    json_result = json.loads(result.content)
-    return json_result["artists"]["items"][0]
+    def __init__(self, workers=CRAWL_WORKERS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.token = None
+        self.token_expires_at = 0
+        self.retry_at = 0
 
-def get_artist_top_tracks(token, artist_id):
-    url = f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks?market=US"
-    headers = get_auth_header(token)
-    result = get(url, headers=headers)
-    
-    if result.status_code != 200:
-        print("Error:", result.content.decode("utf-8"))
-        raise Exception("Failed to get top tracks")
+    def get_token(self):
+        with self.lock:
+            if self.token is None or time.time() >= self.token_expires_at - TOKEN_EXPIRY_MARGIN:
+                token_info = get_token_info(self.session)
+                self.token = token_info["access_token"]
+                self.token_expires_at = time.time() + token_info.get("expires_in", 3600)
+            return self.token
 
-    json_result = json.loads(result.content)
-    return json_result["tracks"]
+    def invalidate_token(self, token):
+        with self.lock:
+            if self.token == token:
+                self.token = None
 
-def get_related_artists(token, artist_id):
-    url = f"https://api.spotify.com/v1/artists/{artist_id}/related-artists"
-    headers = get_auth_header(token)
-    result = get(url, headers=headers)
-    
-    if result.status_code != 200:
-        print("Error:", result.content.decode("utf-8"))
-        raise Exception("Failed to get related artists")
+    def wait_for_rate_limit(self):
+        delay = self.retry_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
 
-    json_result = json.loads(result.content)
-    return json_result["artists"]
+    def get(self, path, error_message, params=None):
+        for _ in range(MAX_RETRIES):
+            self.wait_for_rate_limit()
+            token = self.get_token()
+            result = self.session.get(f"{SPOTIFY_API_URL}{path}", headers=get_auth_header(token), params=params, timeout=REQUEST_TIMEOUT)
 
-def get_audio_features(token, track_ids):
-    url = f"https://api.spotify.com/v1/audio-features?ids={','.join(track_ids)}"
-    headers = get_auth_header(token)
-    result = get(url, headers=headers)
-    
-    if result.status_code != 200:
-        print("Error:", result.content.decode("utf-8"))
-        raise Exception("Failed to get audio features")
+            if result.status_code == 429:
+                # Every worker backs off, not just the one that got the 429
+                retry_after = float(result.headers.get("Retry-After", 1))
+                with self.lock:
+                    self.retry_at = max(self.retry_at, time.time() + retry_after)
+                continue
+            if result.status_code == 401:
+                self.invalidate_token(token)
+                continue
+            if result.status_code != 200:
+                print("Error:", result.content.decode("utf-8"))
+                if result.status_code >= 500:
+                    raise TransientSpotifyError(error_message)
+                raise Exception(error_message)
+            return json.loads(result.content)
+
+        raise TransientSpotifyError(f"{error_message} after {MAX_RETRIES} attempts")
+
+def search_for_artist(client, artist_name):
+    json_result = client.get("/search", "Failed to search for artist", params={"q": artist_name, "type": "artist", "limit": 1})
+    return json_result["artists"]["items"][0]
+
+def get_artist_top_tracks(client, artist_id):
+    json_result = client.get(f"/artists/{artist_id}/top-tracks", "Failed to get top tracks", params={"market": "US"})
+    return json_result["tracks"]
 
-    json_result = json.loads(result.content)
+def get_related_artists(client, artist_id):
+    json_result = client.get(f"/artists/{artist_id}/related-artists", "Failed to get related artists")
+    return json_result["artists"]
+
+def fetch_audio_features(client, track_ids):
+    json_result = client.get("/audio-features", "Failed to get audio features", params={"ids": ",".join(track_ids)})
     return json_result["audio_features"]
 
-def collect_data(artist_names):
-    token = get_token()
-    all_data = []
-    processed_artists = set()
-    for artist_name in artist_names:
-        try:
-            artist = search_for_artist(token, artist_name)
-            if artist["id"] in processed_artists:
+def get_audio_features(client, track_ids):
+    # Tracks analysed before, by an earlier crawl or by a library sync in app1.py, come from the shared cache
+    if track_feature_cache is None:
+        return fetch_audio_features(client, track_ids)
+    return track_feature_cache.audio_features(track_ids, lambda batch: fetch_audio_features(client, batch))
+
+def get_artist_top_rows(client, artist):
+    # Audio features are filled in later by add_audio_features, batched across artists
+    top_tracks = get_artist_top_tracks(client, artist["id"])
+    rows = []
+    for track in top_tracks:
+        rows.append({
+            "artist_name": artist["name"],
+            "track_name": track["name"],
+            "track_id": track["id"],
+            "audio_features": None
+        })
+    return rows
+
+def add_audio_features(client, rows):
+    audio_features = get_audio_features(client, [row["track_id"] for row in rows])
+    for row, track_features in zip(rows, audio_features):
+        row["audio_features"] = track_features
+    return rows
+
+class DatasetWriter:
+    # Streams rows to the dataset CSV as they are produced instead of keeping them all in memory.
+    # When resuming, the track ids already in the file are loaded so no track is written twice.
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.rows_written = 0
+        self.written_track_ids = set()
+        resume = resume and os.path.exists(filename) and os.path.getsize(filename) > 0
+        if resume:
+            with open(filename, newline='', encoding='utf-8') as input_file:
+                for row in csv.DictReader(input_file):
+                    self.written_track_ids.add(row["track_id"])
+
+        self.output_file = open(filename, 'a' if resume else 'w', newline='', encoding='utf-8')
+        self.dict_writer = csv.DictWriter(self.output_file, fieldnames=["artist_name", "track_name", "track_id"] + AUDIO_FEATURE_COLUMNS)
+        if not resume:
+            self.dict_writer.writeheader()
+
+    def write_rows(self, rows):
+        for row in rows:
+            if row["track_id"] in self.written_track_ids:
                 continue
+            self.written_track_ids.add(row["track_id"])
+            audio_features = row["audio_features"] or {}
+            flat_row = {"artist_name": row["artist_name"], "track_name": row["track_name"], "track_id": row["track_id"]}
+            for column in AUDIO_FEATURE_COLUMNS:
+                flat_row[column] = audio_features.get(column)
+            self.dict_writer.writerow(flat_row)
+            self.rows_written += 1
+        self.output_file.flush()
+
+    def close(self):
+        self.output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CrawlCheckpoint:
+    # Periodically saves the processed artists and the pending requests (the frontier) so an
+    # interrupted crawl can resume where it stopped. Removed once the crawl completes, or kept with
+    # only the requests that failed with a transient error, so the next run retries them once.
+
+    def __init__(self, filename, interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.saved_at = time.time()
+
+    def load(self):
+        # Returns (processed artists, frontier, failed requests), the frontier is None without a checkpoint
+        if not os.path.exists(self.filename):
+            return set(), None, []
+        with open(self.filename, "r") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        return (set(checkpoint["processed_artists"]), [tuple(task) for task in checkpoint["frontier"]],
+                [tuple(task) for task in checkpoint.get("failed", [])])
+
+    def save(self, processed_artists, frontier, failed=(), force=False):
+        if not force and time.time() - self.saved_at < self.interval:
+            return False
+        # Written to a temporary file first so a crash never leaves a truncated checkpoint
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as checkpoint_file:
+            json.dump({"processed_artists": list(processed_artists), "frontier": list(frontier), "failed": list(failed)},
+                      checkpoint_file)
+        os.replace(tmp_filename, self.filename)
+        self.saved_at = time.time()
+        return True
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+# Crawl tasks are (kind, label, payload) tuples so the frontier can be checkpointed as JSON.
+# The label is only used in error messages.
+CRAWL_TASKS = {
+    "search": lambda client, payload: search_for_artist(client, payload["name"]),
+    "tracks": get_artist_top_rows,
+    "related": lambda client, payload: get_related_artists(client, payload["id"]),
+    "features": add_audio_features,
+}
+
+def task_priority(task):
+    # Feature batches go first so buffered rows reach the CSV quickly, then artists breadth-first
+    kind, _, payload = task
+    return -1 if kind == "features" else payload["depth"]
+
+def collect_data(artist_names, filename="song_new.csv", workers=CRAWL_WORKERS, max_depth=CRAWL_DEPTH, artist_budget=CRAWL_ARTIST_BUDGET):
+    client = SpotifyClient(workers)
+    checkpoint = CrawlCheckpoint(filename + ".checkpoint.json")
+    processed_artists, frontier, retried_tasks = checkpoint.load()
+    resume = frontier is not None
+    if frontier:
+        print(f"Resuming crawl with {len(processed_artists)} processed artists and {len(frontier)} pending requests")
+    else:
+        # A finished crawl only left failed requests behind: crawl the new seeds and retry those along the way
+        frontier = [("search", artist_name, {"name": artist_name, "depth": 0}) for artist_name in artist_names]
+    if retried_tasks:
+        print(f"Retrying {len(retried_tasks)} requests that failed in the last run")
+
+    with DatasetWriter(filename, resume=resume) as writer, ThreadPoolExecutor(max_workers=workers) as executor:
+        queue = []  # Heap of (priority, sequence, task), shallow artists are expanded first
+        sequence = itertools.count()
+        pending = {}
+        track_buffer = []  # Rows waiting for a full audio-features batch
+        queued_track_ids = set(writer.written_track_ids)
+        attempts = {}  # id(task) -> failed attempts, for tasks that are queued again
+        failed_tasks = []  # Tasks that failed MAX_TASK_ATTEMPTS times with transient errors, kept in the checkpoint
+        last_chance = {id(task) for task in retried_tasks}  # Already failed in the last run, dropped if they fail again
+
+        def enqueue(task):
+            heapq.heappush(queue, (task_priority(task), next(sequence), task))
+
+        def add_artist(label, artist, depth):
+            if artist["id"] in processed_artists:
+                return
+            if artist_budget and len(processed_artists) >= artist_budget:
+                return
             processed_artists.add(artist["id"])
-            top_tracks = get_artist_top_tracks(token, artist["id"])
-            track_ids = [track["id"] for track in top_tracks]
-            audio_features = get_audio_features(token, track_ids)
-            
-            for i, track in enumerate(top_tracks):
-                data = {
-                    "artist_name": artist["name"],
-                    "track_name": track["name"],
-                    "track_id": track["id"],
-                    "audio_features": audio_features[i]
-                }
-                all_data.append(data)
-            
-            related_artists = get_related_artists(token, artist["id"])
-            for related_artist in related_artists:
-                if related_artist["id"] not in processed_artists:
-                    processed_artists.add(related_artist["id"])
-                    top_tracks = get_artist_top_tracks(token, related_artist["id"])
-                    track_ids = [track["id"] for track in top_tracks]
-                    audio_features = get_audio_features(token, track_ids)
-                    
-                    for i, track in enumerate(top_tracks):
-                        data = {
-                            "artist_name": related_artist["name"],
-                            "track_name": track["name"],
-                            "track_id": track["id"],
-                            "audio_features": audio_features[i]
-                        }
-                        all_data.append(data)
-        except Exception as e:
-            print(f"Error collecting data for {artist_name}: {e}")
-    return all_data
-
-def save_to_csv(data, filename="song_new.csv"):
-    keys = data[0].keys()
-    with open(filename, 'w', newline='', encoding='utf-8') as output_file:
-        dict_writer = csv.DictWriter(output_file, fieldnames=keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(data)
+            enqueue(("tracks", label, {"id": artist["id"], "name": artist["name"], "depth": depth}))
+            if depth < max_depth:
+                enqueue(("related", label, {"id": artist["id"], "depth": depth}))
+
+        for task in frontier + retried_tasks:
+            enqueue(task)
+
+        while queue or pending or track_buffer:
+            # A partial feature batch is only sent once nothing else can fill it up
+            while len(track_buffer) >= AUDIO_FEATURES_BATCH_SIZE or (track_buffer and not queue and not pending):
+                batch, track_buffer = track_buffer[:AUDIO_FEATURES_BATCH_SIZE], track_buffer[AUDIO_FEATURES_BATCH_SIZE:]
+                enqueue(("features", f"{len(batch)} tracks", batch))
+
+            # Keep a bounded number of requests in flight so the heap decides what runs next
+            while queue and len(pending) < workers * 2:
+                _, _, task = heapq.heappop(queue)
+                kind, _, payload = task
+                pending[executor.submit(CRAWL_TASKS[kind], client, payload)] = task
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                kind, label, payload = task
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The task's tracks or artist are already marked as queued, so dropping it loses them.
+                    # Only transient errors are worth that: a search without a match fails the same way every time.
+                    failures = attempts.pop(id(task), 0) + 1
+                    print(f"Error collecting data for {label} (attempt {failures}): {e}")
+                    if not is_transient(e):
+                        print(f"Skipping {kind} request for {label}")
+                    elif failures < MAX_TASK_ATTEMPTS:
+                        attempts[id(task)] = failures
+                        enqueue(task)
+                    elif id(task) in last_chance:
+                        print(f"Giving up on {kind} request for {label}, it also failed in the last run")
+                    else:
+                        failed_tasks.append(task)
+                    continue
+                attempts.pop(id(task), None)
+
+                if kind == "search":
+                    add_artist(label, result, 0)
+                elif kind == "related":
+                    for related_artist in result:
+                        add_artist(label, related_artist, payload["depth"] + 1)
+                elif kind == "tracks":
+                    for row in result:
+                        if row["track_id"] not in queued_track_ids:
+                            queued_track_ids.add(row["track_id"])
+                            track_buffer.append(row)
+                else:
+                    writer.write_rows(result)
+
+            frontier = list(pending.values()) + [task for _, _, task in queue]
+            if track_buffer:
+                frontier.append(("features", f"{len(track_buffer)} tracks", track_buffer))
+            if checkpoint.save(processed_artists, frontier, failed_tasks):
+                print(f"{writer.rows_written} tracks written, {len(processed_artists)} artists found, {len(frontier)} requests pending")
+
+    if failed_tasks:
+        # The next run retries them once, the tracks and artists they cover are already marked as done
+        checkpoint.save(processed_artists, [], failed_tasks, force=True)
+        print(f"{len(failed_tasks)} requests failed {MAX_TASK_ATTEMPTS} times, the next run retries them")
+    else:
+        checkpoint.clear()
+    return writer.rows_written
 
 def main():
     artist_names = ["ACDC", "The Beatles", "Eminem", "Taylor Swift","Drake", "Travis Scott", "Future"]  # Add more artist names as needed
-    data = collect_data(artist_names)
-    print(json.dumps(data, indent=4))
-    save_to_csv(data)
+    rows_written = collect_data(artist_names)
+    print(f"Saved {rows_written} tracks to song_new.csv")
+    if track_feature_cache is not None:
+        stats = track_feature_cache.stats()
+        print(f"Audio features: {stats['hits']} from cache, {stats['misses']} fetched")
 
 if __name__ == "__main__":
     main()
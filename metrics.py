@@ -0,0 +1,200 @@
+import bisect
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+
+# Per-stage latency of the chat pipelines. Every span is recorded in a Prometheus-style histogram
+# (GET /metrics) and, while a request is being handled, added to that response's Server-Timing header.
+# Recording a span is a perf_counter() pair, a bisect over the bucket bounds and an increment under a
+# lock, a few microseconds, so it stays on in production.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") != "0"  # 0 = histograms only, no Server-Timing header
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # Seconds between copies of a worker's histograms to the state store
+METRICS_TTL = 24 * 3600  # Seconds the histograms of a worker that stopped flushing are still reported
+
+# Seconds, from a cached lookup to a slow upstream call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # Cumulative-bucket histogram in the Prometheus text format. Counts are kept per bucket and
+    # summed when rendered, so observe() touches one counter.
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class HistogramFamily:
+    # One histogram per label value, e.g. one per pipeline stage
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value):
+        histogram = self.histograms.get(value)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(value, Histogram(self.buckets))
+        return histogram
+
+    def snapshot(self):
+        return {value: histogram.snapshot() for value, histogram in list(self.histograms.items())}
+
+    def render(self, snapshot):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for value, (counts, total) in sorted(snapshot.items()):
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return "\n".join(lines)
+
+
+stage_seconds = HistogramFamily("chat_stage_seconds", "Time spent in each stage of a chat request.", "stage")
+request_seconds = HistogramFamily("http_request_seconds", "Time to handle a request, by endpoint.", "endpoint")
+
+
+def record(stage, seconds):
+    stage_seconds.labels(stage).observe(seconds)
+    if SERVER_TIMING and has_request_context():
+        timings = g.get('server_timing')
+        if timings is not None:
+            timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    # with span("spotify_search"): ...
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def server_timing_header(timings, total=None):
+    # Repeated stages (e.g. one search per batch seed) are summed into one entry
+    durations = {}
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in durations.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+families = (stage_seconds, request_seconds)
+
+
+class WorkerMetrics:
+    # With several worker processes, each one copies its histograms to the state store every
+    # METRICS_FLUSH_INTERVAL from a background thread, and /metrics adds up the copies of all workers,
+    # whichever worker serves it. The thread is started by the worker's first request, after the fork.
+
+    def __init__(self, store, name):
+        self.store = store
+        self.namespace = f"metrics:{name}"  # Apps sharing one state store are reported separately
+        self.pid = None
+        self.key = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.key = f"{self.pid}-{uuid.uuid4().hex}"
+        threading.Thread(target=self.run, name="metrics-flush", daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        self.store.set(self.namespace, self.key, [family.snapshot() for family in families], ttl=METRICS_TTL)
+
+    def snapshots(self):
+        self.start()
+        self.flush()
+        merged = [{} for _ in families]
+        for _, worker in self.store.items(self.namespace):
+            for totals, snapshot in zip(merged, worker):
+                for value, (counts, total) in snapshot.items():
+                    if value in totals:
+                        previous_counts, previous_total = totals[value]
+                        counts = [a + b for a, b in zip(previous_counts, counts)]
+                        total += previous_total
+                    totals[value] = (counts, total)
+        return merged
+
+
+def render(snapshots=None):
+    if snapshots is None:
+        snapshots = [family.snapshot() for family in families]
+    return "\n".join(family.render(snapshot) for family, snapshot in zip(families, snapshots)) + "\n"
+
+
+def init_app(app, store=None):
+    # Times every request, adds the Server-Timing header and serves the histograms on GET /metrics.
+    # Pass the state store when the app runs in several worker processes.
+    if not METRICS_ENABLED:
+        return
+    worker_metrics = WorkerMetrics(store, app.name) if store is not None else None
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.server_timing = []
+
+    @app.after_request
+    def add_server_timing(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        request_seconds.labels(request.endpoint or "unknown").observe(total)
+        if worker_metrics is not None:
+            worker_metrics.start()
+        # Streamed responses send their headers before the work is done, their stages only reach /metrics
+        if SERVER_TIMING and not response.is_streamed:
+            response.headers['Server-Timing'] = server_timing_header(g.server_timing, total)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        snapshots = worker_metrics.snapshots() if worker_metrics is not None else None
+        return Response(render(snapshots), mimetype='text/plain; version=0.0.4')
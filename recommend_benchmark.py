@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+from feature_store import StringColumn, VectorScaler
+from similarity import SimilarityEngine
+
+# Per-request cost of the /chat recommend path in app1.py, from the song's audio-features dict to the
+# formatted reply, on synthetic data. Both paths use the same SimilarityEngine, so the difference is
+# the pandas overhead around the search.
+
+COLUMNS = ["danceability", "energy", "key", "loudness", "mode", "speechiness", "acousticness",
+           "instrumentalness", "liveness", "valence", "tempo", "duration_ms", "time_signature"]
+
+
+def pandas_recommend(song_features, scaler, engine, df, n=10):
+    # The previous path: one-row DataFrame, sklearn transform, df.iloc and iterrows
+    song_features_df = pd.DataFrame([song_features])
+    song_features_df = song_features_df[COLUMNS]
+    song_features_scaled = scaler.transform(song_features_df)
+    exclude = np.flatnonzero(df['id'].to_numpy() == song_features['id'])
+    indices, _ = engine.query(song_features_scaled[0], k=n, exclude=exclude)
+    similar_songs = df.iloc[indices][['artist_name', 'track_name']]
+    return "<br>".join([f"{song['artist_name']} - {song['track_name']}" for _, song in similar_songs.iterrows()])
+
+
+def numpy_recommend(song_features, vector_scaler, engine, ids, artist_names, track_names, n=10):
+    song_vector = vector_scaler.transform_one(song_features)
+    exclude = ids.positions([song_features['id']])
+    indices, _ = engine.query(song_vector, k=n, exclude=exclude)
+    return "<br>".join([f"{artist_names[i]} - {track_names[i]}" for i in indices])
+
+
+def benchmark(sizes=(2_000, 100_000, 1_000_000), queries=200):
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        raw = rng.standard_normal((size, len(COLUMNS))).astype(np.float32)
+        df = pd.DataFrame({'id': [f"t{i:021d}" for i in range(size)],  # 22 characters, like Spotify ids
+                           'artist_name': [f"artist {i % 5000}" for i in range(size)],
+                           'track_name': [f"track {i}" for i in range(size)]})
+        scaler = StandardScaler().fit(pd.DataFrame(raw, columns=COLUMNS))
+        vector_scaler = VectorScaler(COLUMNS, scaler.mean_, scaler.scale_)
+        engine = SimilarityEngine(vector_scaler.transform(raw))
+        ids = StringColumn.from_strings(df['id'])
+        artist_names = StringColumn.from_strings(df['artist_name'])
+        track_names = StringColumn.from_strings(df['track_name'])
+        songs = [dict(zip(COLUMNS, map(float, raw[i])), id=f"t{i:021d}") for i in rng.integers(0, size, queries)]
+
+        start = time.perf_counter()
+        for song in songs:
+            pandas_recommend(song, scaler, engine, df)
+        pandas_ms = (time.perf_counter() - start) / queries * 1000
+
+        start = time.perf_counter()
+        for song in songs:
+            numpy_recommend(song, vector_scaler, engine, ids, artist_names, track_names)
+        numpy_ms = (time.perf_counter() - start) / queries * 1000
+
+        print(f"{size:>9} rows: pandas path {pandas_ms:8.3f} ms/request | numpy path {numpy_ms:8.3f} ms/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the pandas and NumPy recommend paths of app1.py.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[2_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    benchmark(sizes=args.rows, queries=args.queries)
@@ -0,0 +1,98 @@
+import time
+import numpy as np
+
+
+class SimilarityEngine:
+    # Cosine-similarity top-k search over a fixed feature matrix.
+    # Rows are L2-normalized once at build time, so a query is one mat-vec plus argpartition.
+
+    def __init__(self, features):
+        self.matrix = self._normalize(features)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @staticmethod
+    def _normalize(features):
+        matrix = np.array(features, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1  # All-zero rows stay zero instead of turning into NaN
+        matrix /= norms
+        return matrix
+
+    def extended(self, features):
+        # A new engine with extra rows appended, the existing rows are not normalized again
+        engine = SimilarityEngine.__new__(SimilarityEngine)
+        engine.matrix = np.concatenate([self.matrix, self._normalize(features).reshape(-1, self.matrix.shape[1])])
+        return engine
+
+    def query(self, vector, k=10, exclude=None):
+        # Returns (indices, scores) of the k most similar rows, best match first.
+        # `exclude` is a row index or a list of row indices that must not be returned (e.g. the seed track).
+        scores = self.matrix @ self._normalize(vector)[0]
+        if exclude is not None:
+            scores[exclude] = -np.inf
+            k = min(k, len(scores) - np.count_nonzero(np.isneginf(scores)))
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+    def query_batch(self, matrix, k=10, exclude=None):
+        # Batched version of query(): returns (indices, scores) arrays of shape (n_queries, k).
+        # `exclude` is an optional sequence with one row index (or None) per query. A query left with fewer
+        # than k rows once its exclusions are removed is padded with index -1 and score -inf.
+        scores = self._normalize(matrix) @ self.matrix.T
+        if exclude is not None:
+            for row, index in enumerate(exclude):
+                if index is not None:
+                    scores[row, index] = -np.inf
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return np.empty((scores.shape[0], 0), dtype=np.intp), np.empty((scores.shape[0], 0), dtype=np.float32)
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+        top[np.isneginf(top_scores)] = -1
+        return top, top_scores
+
+
+def _full_sort_query(vector, features, k):
+    # The previous approach: normalize the whole matrix per query and argsort every row
+    norms = np.linalg.norm(features, axis=1)
+    norms[norms == 0] = 1
+    similarities = (features @ vector) / (norms * np.linalg.norm(vector))
+    return similarities.argsort()[-k:][::-1]
+
+
+def benchmark(sizes=(10_000, 100_000, 1_000_000), dims=13, k=10, queries=20):
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        features = rng.standard_normal((size, dims))
+        vectors = rng.standard_normal((queries, dims))
+
+        start = time.perf_counter()
+        for vector in vectors:
+            _full_sort_query(vector, features, k)
+        full_sort_ms = (time.perf_counter() - start) / queries * 1000
+
+        engine = SimilarityEngine(features)
+        start = time.perf_counter()
+        for vector in vectors:
+            engine.query(vector, k)
+        query_ms = (time.perf_counter() - start) / queries * 1000
+
+        start = time.perf_counter()
+        engine.query_batch(vectors, k)
+        batch_ms = (time.perf_counter() - start) / queries * 1000
+
+        print(f"{size:>9} rows: full sort {full_sort_ms:8.3f} ms/query | query {query_ms:8.3f} ms/query | query_batch {batch_ms:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    benchmark()
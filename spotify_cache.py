@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from caching import LRUCache, RequestCoalescer
+from state_store import SQLiteConnections
+
+# Seconds a response is fresh, per endpoint. After that it is served stale for the same amount
+# of time while it is refreshed in the background, then it expires.
+SPOTIFY_CACHE_TTLS = {
+    "search": int(os.getenv("SPOTIFY_SEARCH_TTL", "3600")),
+    "recommendations": int(os.getenv("SPOTIFY_RECOMMENDATIONS_TTL", "1800")),
+    "artist_related_artists": int(os.getenv("SPOTIFY_RELATED_ARTISTS_TTL", "86400")),
+}
+SPOTIFY_CACHE_SIZE = int(os.getenv("SPOTIFY_CACHE_SIZE", "4096"))
+SPOTIFY_CACHE_DB = os.getenv("SPOTIFY_CACHE_DB")  # Optional SQLite file shared by all workers on the host
+
+
+class SQLiteCache:
+    # Second cache tier in a local SQLite file, so several gunicorn workers share what each one fetched
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self.writes = 0
+        self.connections = SQLiteConnections(path, timeout=5)
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS spotify_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, expires_at REAL NOT NULL)")
+        self.connection().commit()
+
+    def connection(self):
+        return self.connections.get()
+
+    def get(self, key):
+        row = self.connection().execute(
+            "SELECT value, stored_at FROM spotify_cache WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return row[1], json.loads(row[0])
+
+    def set(self, key, value, stored_at, expires_at):
+        connection = self.connection()
+        connection.execute("INSERT OR REPLACE INTO spotify_cache (key, value, stored_at, expires_at) VALUES (?, ?, ?, ?)",
+                           (key, json.dumps(value), stored_at, expires_at))
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            connection.execute("DELETE FROM spotify_cache WHERE expires_at <= ?", (time.time(),))
+        connection.commit()
+
+
+class SpotifyResponseCache:
+    # Caches Spotify Web API responses in memory (LRU) and optionally in SQLite, with per-endpoint TTLs
+    # and stale-while-revalidate. Cached values are shared between requests and must not be mutated.
+
+    def __init__(self, ttls=SPOTIFY_CACHE_TTLS, maxsize=SPOTIFY_CACHE_SIZE, db_path=SPOTIFY_CACHE_DB):
+        self.ttls = ttls
+        self.memory = LRUCache(maxsize=maxsize)
+        self.sqlite = SQLiteCache(db_path) if db_path else None
+        self.coalescer = RequestCoalescer()
+        self.refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="spotify-cache-refresh")
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.counters = {endpoint: {"hits": 0, "stale_hits": 0, "sqlite_hits": 0, "misses": 0} for endpoint in ttls}
+
+    def count(self, endpoint, counter):
+        with self.lock:
+            self.counters[endpoint][counter] += 1
+
+    def lookup(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.sqlite is not None:
+            entry = self.sqlite.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+                return entry, True
+        return entry, False
+
+    def store(self, endpoint, key, value):
+        stored_at = time.time()
+        self.memory.set(key, (stored_at, value))
+        if self.sqlite is not None:
+            self.sqlite.set(key, value, stored_at, stored_at + 2 * self.ttls[endpoint])
+
+    def call(self, endpoint, fetch, *args, **kwargs):
+        ttl = self.ttls[endpoint]
+        key = json.dumps([endpoint, args, kwargs], sort_keys=True)
+        entry, from_sqlite = self.lookup(key)
+        if entry is not None:
+            stored_at, value = entry
+            age = time.time() - stored_at
+            if age < ttl:
+                self.count(endpoint, "sqlite_hits" if from_sqlite else "hits")
+                return value
+            if age < 2 * ttl:
+                self.count(endpoint, "stale_hits")
+                self.refresh(endpoint, key, fetch, args, kwargs)
+                return value
+
+        self.count(endpoint, "misses")
+
+        def fetch_and_store():
+            value = fetch(*args, **kwargs)
+            self.store(endpoint, key, value)
+            return value
+
+        return self.coalescer.run(key, fetch_and_store)
+
+    def refresh(self, endpoint, key, fetch, args, kwargs):
+        # One background refresh per key, the stale value keeps being served until it lands
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self.store(endpoint, key, fetch(*args, **kwargs))
+            except Exception:
+                pass  # The stale entry stays until it expires, the next miss retries in the foreground
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        self.refresher.submit(run)
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for endpoint, counters in self.counters.items():
+                lookups = sum(counters.values())
+                stats[endpoint] = dict(counters, hit_ratio=(lookups - counters["misses"]) / lookups if lookups else 0.0)
+        stats["memory"] = {"size": len(self.memory), "maxsize": self.memory.maxsize}
+        return stats
+
+
+class CachedSpotify:
+    # Wraps a spotipy client so the catalog lookups used by /chat go through a SpotifyResponseCache
+
+    def __init__(self, sp, cache):
+        self.sp = sp
+        self.cache = cache
+
+    def search(self, *args, **kwargs):
+        return self.cache.call("search", self.sp.search, *args, **kwargs)
+
+    def recommendations(self, *args, **kwargs):
+        return self.cache.call("recommendations", self.sp.recommendations, *args, **kwargs)
+
+    def artist_related_artists(self, *args, **kwargs):
+        return self.cache.call("artist_related_artists", self.sp.artist_related_artists, *args, **kwargs)
@@ -0,0 +1,69 @@
+import os
+import uuid
+import requests
+from spotipy import Spotify
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+from caching import LRUCache
+from state_store import StateCacheHandler
+
+# Base URLs can point at a local fake Spotify server, as in main.py
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+SPOTIFY_TOKEN_TTL = 30 * 24 * 3600  # Seconds a stored token is kept, about the lifetime of a session
+
+
+def spotify_oauth(**kwargs):
+    # SpotifyOAuth whose token requests go to SPOTIFY_ACCOUNTS_URL
+    auth_manager = SpotifyOAuth(**kwargs)
+    auth_manager.OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+    auth_manager.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+    return auth_manager
+
+
+class SpotifyClientCache:
+    # In-process Spotify clients, one per logged-in user, keyed by an id stored in the user's session.
+    # Each client keeps that user's token info in memory (spotipy refreshes it shortly before it
+    # expires) and its own requests session, so repeated calls reuse the same TLS connection.
+    # With a state store the token info is also written there, and a worker that doesn't have the
+    # client yet (another process, or after eviction) rebuilds it from the stored token.
+
+    def __init__(self, client_id, client_secret, redirect_uri, scope, maxsize=1024, store=None,
+                 session_factory=requests.Session):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scope = scope
+        self.clients = LRUCache(maxsize=maxsize)
+        self.store = store
+        self.session_factory = session_factory
+
+    def _client(self, key, token_info, requests_session=None):
+        if self.store is not None:
+            cache_handler = StateCacheHandler(self.store, key, token_info, ttl=SPOTIFY_TOKEN_TTL)
+        else:
+            cache_handler = MemoryCacheHandler(token_info=token_info)
+        auth_manager = spotify_oauth(client_id=self.client_id, client_secret=self.client_secret,
+                                    redirect_uri=self.redirect_uri, scope=self.scope, cache_handler=cache_handler)
+        client = Spotify(auth_manager=auth_manager, requests_session=requests_session or self.session_factory())
+        client.prefix = f"{SPOTIFY_API_URL}/"
+        self.clients.set(key, client)
+        return client
+
+    def add(self, token_info, requests_session=None):
+        key = uuid.uuid4().hex
+        client = self._client(key, token_info, requests_session)
+        if self.store is not None:
+            client.auth_manager.cache_handler.save_token_to_cache(token_info)
+        return key
+
+    def get(self, key):
+        if key is None:
+            return None
+        client = self.clients.get(key)
+        if client is None and self.store is not None:
+            token_info = self.store.get(StateCacheHandler.namespace, key)
+            if token_info is not None:
+                client = self._client(key, token_info)
+        return client
@@ -0,0 +1,146 @@
+import os
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from spotipy.cache_handler import CacheHandler
+from werkzeug.datastructures import CallbackDict
+
+# Per-user state shared by every worker process on the host: sessions, chat state, Spotify tokens and
+# background job status, as pickled values in one local SQLite file (WAL mode, so readers never wait
+# for a writer). A lookup is one primary-key read, a few tens of microseconds.
+
+STATE_DB = os.getenv("STATE_DB", "state.db")
+STATE_PRUNE_EVERY = 1000  # Writes between sweeps of expired entries
+
+
+class SQLiteConnections:
+    # One connection per thread of each process, for SQLite files shared between threads and forked workers:
+    # sqlite3 connections can't be used from another thread or carried across a fork. WAL mode lets readers
+    # run while another process writes.
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+
+class StateStore:
+    def __init__(self, path=STATE_DB, prune_every=STATE_PRUNE_EVERY):
+        self.path = path
+        self.prune_every = prune_every
+        self.writes = 0
+        self.connections = SQLiteConnections(path)
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+            "expires_at REAL, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+        self.connection().commit()
+
+    def connection(self):
+        return self.connections.get()
+
+    def get(self, namespace, key, default=None):
+        row = self.connection().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else default
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        connection = self.connection()
+        connection.execute("INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                           (namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires_at))
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            connection.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+        connection.commit()
+
+    def items(self, namespace):
+        rows = self.connection().execute(
+            "SELECT key, value FROM state WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, time.time())).fetchall()
+        return [(key, pickle.loads(value)) for key, value in rows]
+
+    def delete(self, namespace, key):
+        connection = self.connection()
+        connection.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+        connection.commit()
+
+
+class StoredSession(CallbackDict, SessionMixin):
+    def __init__(self, sid, initial=None, new=False):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class StateSessionInterface(SessionInterface):
+    # Server-side Flask sessions in the state store. The cookie only carries a random session id, and
+    # a session is only written back when it changed.
+
+    namespace = "session"
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(self.namespace, sid)
+            if data is not None:
+                return StoredSession(sid, data)
+        return StoredSession(secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(self.namespace, session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.set(self.namespace, session.sid, dict(session), ttl=lifetime)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), httponly=True,
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+class StateCacheHandler(CacheHandler):
+    # Spotify token info kept in memory and written through to the state store, so a client can be
+    # rebuilt in any worker and tokens refreshed by spotipy survive a restart
+
+    namespace = "spotify_token"
+
+    def __init__(self, store, key, token_info=None, ttl=None):
+        self.store = store
+        self.key = key
+        self.token_info = token_info
+        self.ttl = ttl
+
+    def get_cached_token(self):
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        self.store.set(self.namespace, self.key, token_info, ttl=self.ttl)
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+
+from ann_index import spherical_kmeans
+from similarity import SimilarityEngine
+
+TASTE_CLUSTERS = int(os.getenv("TASTE_CLUSTERS", "4"))  # Taste vectors kept per user
+TASTE_CANDIDATES = int(os.getenv("TASTE_CANDIDATES", "200"))  # Catalog tracks retrieved before re-ranking
+TASTE_WEIGHT = float(os.getenv("TASTE_WEIGHT", "0.4"))  # Share of the final score that comes from the user's taste
+
+
+def taste_vectors(scaled, clusters=TASTE_CLUSTERS):
+    # A user's taste as a few unit vectors, the spherical k-means centroids of their library rows.
+    # This (clusters x features floats) is all the per-user state the catalog recommender needs.
+    matrix = SimilarityEngine._normalize(scaled)
+    matrix = matrix[np.any(matrix != 0, axis=1)]
+    clusters = min(clusters, len(matrix))
+    if clusters == 0:
+        return np.empty((0, matrix.shape[1]), dtype=np.float32)
+    return spherical_kmeans(matrix, clusters)
+
+
+class TwoStageRecommender:
+    # Recommends from the whole catalog. Stage 1 retrieves candidates close to the query from the shared,
+    # read-only catalog engine (exact or IVF); stage 2 re-ranks them by how close they also are to the
+    # nearest of the user's taste vectors. Tracks the user already has are skipped, so results are new music.
+
+    def __init__(self, engine, features, ids, candidates=TASTE_CANDIDATES, weight=TASTE_WEIGHT):
+        self.engine = engine  # SimilarityEngine or IVFIndex over the catalog
+        self.features = features  # Scaled catalog rows, only the candidates' rows are read
+        self.ids = ids
+        self.candidates = candidates
+        self.weight = weight
+
+    def _rerank(self, indices, scores, taste, k, exclude_ids):
+        keep = np.array([self.ids[i] not in exclude_ids for i in indices], dtype=bool)
+        indices, scores = indices[keep], scores[keep]
+        if len(indices) == 0:
+            return indices, scores
+        if len(taste) > 0:
+            taste_scores = (SimilarityEngine._normalize(self.features[indices]) @ taste.T).max(axis=1)
+            scores = (1 - self.weight) * scores + self.weight * taste_scores
+        top = np.argsort(-scores, kind='stable')[:k]
+        return indices[top], scores[top]
+
+    def recommend(self, vector, taste, k=10, exclude_ids=frozenset()):
+        # Catalog tracks similar to `vector` (a scaled seed track), re-ranked by taste
+        indices, scores = self.engine.query(vector, k=self.candidates)
+        return self._rerank(indices, scores, taste, k, exclude_ids)
+
+    def discover(self, taste, k=10, exclude_ids=frozenset()):
+        # Catalog tracks for the user's taste alone: candidates around every taste vector, each scored by
+        # its closest taste vector
+        if len(taste) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        indices, scores = self.engine.query_batch(taste, k=max(k, self.candidates // len(taste)))
+        indices, scores = indices.ravel(), scores.ravel()
+        found = indices >= 0  # Padding of taste vectors that found fewer than k candidates
+        indices, scores = indices[found], scores[found]
+        order = np.argsort(-scores, kind='stable')
+        indices, first = np.unique(indices[order], return_index=True)
+        scores = scores[order][first]
+        keep = np.array([self.ids[i] not in exclude_ids for i in indices], dtype=bool)
+        indices, scores = indices[keep], scores[keep]
+        top = np.argsort(-scores, kind='stable')[:k]
+        return indices[top], scores[top]
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from caching import LRUCache, RequestCoalescer
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache(maxsize=10, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=10)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+
+
+def test_lru_cache_counts_hits_and_misses():
+    cache = LRUCache(maxsize=10)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("missing", "default")
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 1, 1)
+    assert stats["hit_ratio"] == pytest.approx(2 / 3)
+
+
+def test_coalescer_shares_one_call_between_concurrent_callers():
+    coalescer = RequestCoalescer()
+    calls = []
+    release = threading.Event()
+
+    def function():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(coalescer.run("key", function))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # Let every caller reach run() before the leader's call finishes
+    while coalescer.coalesced < len(threads) - 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == ["result"] * len(threads)
+    assert coalescer.coalesced == len(threads) - 1
+
+
+def test_coalescer_shares_errors_and_forgets_the_call():
+    coalescer = RequestCoalescer()
+
+    def failing():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        coalescer.run("key", failing)
+    # A finished call is not remembered, the next caller runs the function again
+    assert coalescer.run("key", lambda: "retried") == "retried"
+
+
+def test_coalescer_runs_different_keys_independently():
+    coalescer = RequestCoalescer()
+    assert coalescer.run("a", lambda: 1) == 1
+    assert coalescer.run("b", lambda: 2) == 2
+    assert coalescer.coalesced == 0
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+import pytest
+
+from fake_services import FakeServiceConfig, start_fake_openai
+
+# ask_openai in app.py, against a local stub of the OpenAI chat API (fake_services.py) instead of the real one
+
+
+@pytest.fixture(scope="module")
+def openai_stub():
+    config = FakeServiceConfig(openai_latency=0.0, token_delay=0.0)
+    server = start_fake_openai(config)
+    yield config, server
+    server.stop()
+
+
+@pytest.fixture(scope="module")
+def app_module(openai_stub, tmp_path_factory):
+    _, server = openai_stub
+    workdir = tmp_path_factory.mktemp("app")
+    os.environ.update({"CLIENT_ID": "test", "CLIENT_SECRET": "test", "OPENAI_API_KEY": "test",
+                       "OPENAI_API_BASE": f"{server.url}/v1", "STATE_DB": str(workdir / "state.db")})
+    import openai
+    import app
+    openai.api_base = f"{server.url}/v1"  # openai reads OPENAI_API_BASE when it is first imported
+    return app
+
+
+@pytest.fixture
+def stub(openai_stub, app_module):
+    # A clean cache and default stub behaviour for every test
+    config, server = openai_stub
+    config.openai_latency = 0.0
+    config.rate_limit = 0.0
+    app_module.openai_cache.clear()
+    server.counters.clear()
+    return config, server
+
+
+def upstream_calls(server):
+    return server.counters.get("chat_completions", 0)
+
+
+def test_cache_miss_then_hit(app_module, stub):
+    _, server = stub
+    answer = app_module.ask_openai("What is shoegaze?")
+    assert "shoegaze" in answer
+    assert upstream_calls(server) == 1
+
+    # The same prompt after normalization is answered from the cache
+    assert app_module.ask_openai("what is  shoegaze") == answer
+    assert upstream_calls(server) == 1
+    stats = app_module.openai_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_concurrent_identical_prompts_make_one_upstream_call(app_module, stub):
+    config, server = stub
+    config.openai_latency = 0.3
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(app_module.ask_openai("What is dream pop?")))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert upstream_calls(server) == 1
+    assert len(set(answers)) == 1
+    assert "dream pop" in answers[0]
+
+
+def test_errors_are_not_cached(app_module, stub):
+    config, server = stub
+    config.rate_limit = 1.0  # Every request is answered with HTTP 429
+    answer = app_module.ask_openai("What is krautrock?")
+    assert "high demand" in answer
+    calls = upstream_calls(server)
+    assert calls >= 1
+
+    config.rate_limit = 0.0
+    answer = app_module.ask_openai("What is krautrock?")
+    assert "krautrock" in answer
+    assert upstream_calls(server) == calls + 1
+
+
+def test_timeout_is_applied(app_module, stub, monkeypatch):
+    config, server = stub
+    config.openai_latency = 2.0
+    monkeypatch.setattr(app_module, "OPENAI_TIMEOUT", 0.2)
+    start = time.perf_counter()
+    answer = app_module.ask_openai("What is post-rock?")
+    assert time.perf_counter() - start < 1.5
+    assert answer == "I'm sorry, but I couldn't process your request at the moment."
+    assert app_module.openai_cache.get(app_module.openai_cache_key("What is post-rock?")) is None
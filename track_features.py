@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import threading
+
+from state_store import SQLiteConnections
+
+# Audio features by Spotify track id, shared by the crawler (main.py) and library syncs (app1.py) through
+# one SQLite file. A track's analysis never changes, so entries don't expire. Tracks Spotify has no
+# analysis for are not stored and are asked for again next time.
+
+TRACK_FEATURES_DB = os.getenv("TRACK_FEATURES_DB", "track_features.db")  # Empty to disable the cache
+AUDIO_FEATURES_BATCH_SIZE = 100  # Maximum number of ids per audio-features call
+SQLITE_MAX_VARIABLES = 500  # Ids per SELECT, below SQLite's limit on bound parameters
+INTEGER_FEATURES = ["key", "mode", "duration_ms", "time_signature"]
+
+
+class TrackFeatureCache:
+    def __init__(self, path=TRACK_FEATURES_DB):
+        self.path = path
+        self.connections = SQLiteConnections(path)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connection().execute("CREATE TABLE IF NOT EXISTS track_features (id TEXT PRIMARY KEY, features TEXT NOT NULL)")
+        self.connection().commit()
+
+    def connection(self):
+        return self.connections.get()
+
+    def get_many(self, track_ids):
+        # Returns {track id: features} for the ids that are cached
+        track_ids = list({track_id for track_id in track_ids if track_id is not None})
+        found = {}
+        for i in range(0, len(track_ids), SQLITE_MAX_VARIABLES):
+            chunk = track_ids[i:i + SQLITE_MAX_VARIABLES]
+            rows = self.connection().execute(
+                f"SELECT id, features FROM track_features WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            for track_id, features in rows:
+                found[track_id] = json.loads(features)
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(track_ids) - len(found)
+        return found
+
+    def set_many(self, features_by_id):
+        rows = [(track_id, json.dumps(features)) for track_id, features in features_by_id.items() if features]
+        if rows:
+            connection = self.connection()
+            connection.executemany("INSERT OR REPLACE INTO track_features (id, features) VALUES (?, ?)", rows)
+            connection.commit()
+
+    def audio_features(self, track_ids, fetch, batch_size=AUDIO_FEATURES_BATCH_SIZE):
+        # Same result as fetch(track_ids), one entry per id and None where there is no analysis, but only
+        # ids missing from the cache are passed to fetch, in batches of at most batch_size
+        features_by_id = self.get_many(track_ids)
+        missing = list(dict.fromkeys(track_id for track_id in track_ids
+                                     if track_id is not None and track_id not in features_by_id))
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            fetched = dict(zip(batch, fetch(batch)))
+            self.set_many(fetched)
+            features_by_id.update(fetched)
+        return [features_by_id.get(track_id) for track_id in track_ids]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+def open_track_feature_cache(path=TRACK_FEATURES_DB):
+    return TrackFeatureCache(path) if path else None
+
+
+def import_csv(cache, csv_path):
+    # Seeds the cache from a crawled dataset, in either the flattened or the older stringified format.
+    # pandas is only needed here, the crawler imports this module without it.
+    import pandas as pd
+    from feature_store import parse_audio_features
+
+    df = pd.read_csv(csv_path)
+    if 'audio_features' in df.columns:
+        rows = [parse_audio_features(features) for features in df['audio_features'].dropna()]
+    else:
+        # Tracks without an analysis have empty feature columns
+        df = df.drop(columns=["artist_name", "track_name", "track_id"], errors="ignore").dropna()
+        rows = df.to_dict("records")
+    features_by_id = {}
+    for features in rows:
+        if features:
+            # Columns with empty cells are read as floats, the API returns these as integers
+            features_by_id[features["id"]] = {key: (int(value) if key in INTEGER_FEATURES else value)
+                                              for key, value in features.items()}
+    cache.set_many(features_by_id)
+    return len(features_by_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import crawled audio features into the shared track feature cache.")
+    parser.add_argument("csv", nargs="+", help="datasets written by main.py")
+    parser.add_argument("--db", default=TRACK_FEATURES_DB or "track_features.db")
+    args = parser.parse_args()
+    cache = TrackFeatureCache(args.db)
+    for csv_path in args.csv:
+        print(f"{csv_path}: {import_csv(cache, csv_path)} tracks")
@@ -0,0 +1,116 @@
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+# Per-user chat state with bounded memory.
+#
+# Exact mode keeps at most HISTORY_MAX_GENRES genres x HISTORY_MAX_ITEMS track ids per user, at roughly
+# 150 bytes per id (dict entry, id string, timestamp): about 600 KB per user in the worst case with the
+# defaults, a few KB for a typical user. Bloom mode stores each genre in two rotating Bloom filters of
+# HISTORY_BLOOM_CAPACITY ids at a 1% false-positive rate: about 12 KB per genre, 240 KB per user at most,
+# however long the history grows. Preferred genres and liked songs keep the last MAX_PREFERENCES entries each.
+
+HISTORY_MAX_GENRES = int(os.getenv("HISTORY_MAX_GENRES", "20"))
+HISTORY_MAX_ITEMS = int(os.getenv("HISTORY_MAX_ITEMS", "200"))
+HISTORY_MAX_AGE = int(os.getenv("HISTORY_MAX_AGE", str(7 * 24 * 3600)))  # Seconds before a track may be recommended again
+HISTORY_BLOOM = os.getenv("HISTORY_BLOOM", "0") == "1"
+HISTORY_BLOOM_CAPACITY = int(os.getenv("HISTORY_BLOOM_CAPACITY", "5000"))
+MAX_PREFERENCES = int(os.getenv("MAX_PREFERENCES", "50"))
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+class RotatingBloomFilter:
+    # Two generations: once the current filter is full it becomes the previous one and the oldest
+    # generation is dropped, which bounds memory and approximates age-based eviction
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.current = BloomFilter(capacity)
+        self.previous = None
+
+    def add(self, item):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity)
+        self.current.add(item)
+
+    def __contains__(self, item):
+        return item in self.current or (self.previous is not None and item in self.previous)
+
+
+class RecommendationHistory:
+    # Track ids already recommended to one user, per genre
+
+    def __init__(self, max_genres=HISTORY_MAX_GENRES, max_items=HISTORY_MAX_ITEMS, max_age=HISTORY_MAX_AGE,
+                 bloom=HISTORY_BLOOM, bloom_capacity=HISTORY_BLOOM_CAPACITY):
+        self.max_genres = max_genres
+        self.max_items = max_items
+        self.max_age = max_age
+        self.bloom = bloom
+        self.bloom_capacity = bloom_capacity
+        self.genres = OrderedDict()  # genre -> OrderedDict(track id -> added at), or RotatingBloomFilter
+
+    def _genre(self, genre, create=False):
+        entries = self.genres.get(genre)
+        if entries is None and create:
+            entries = RotatingBloomFilter(self.bloom_capacity) if self.bloom else OrderedDict()
+            self.genres[genre] = entries
+            while len(self.genres) > self.max_genres:
+                self.genres.popitem(last=False)
+        if entries is not None:
+            self.genres.move_to_end(genre)
+        return entries
+
+    def _expire(self, entries):
+        # Entries are in insertion order, so expired ones are always at the front
+        cutoff = time.time() - self.max_age
+        while entries and next(iter(entries.values())) < cutoff:
+            entries.popitem(last=False)
+
+    def seen(self, genre, track_id):
+        entries = self._genre(genre)
+        if entries is None:
+            return False
+        if not self.bloom:
+            self._expire(entries)
+        return track_id in entries
+
+    def add(self, genre, track_id):
+        entries = self._genre(genre, create=True)
+        if self.bloom:
+            entries.add(track_id)
+            return
+        entries[track_id] = time.time()
+        entries.move_to_end(track_id)
+        while len(entries) > self.max_items:
+            entries.popitem(last=False)
+
+
+class UserState:
+    def __init__(self):
+        self.genres = deque(maxlen=MAX_PREFERENCES)
+        self.liked_songs = deque(maxlen=MAX_PREFERENCES)
+        self.history = RecommendationHistory()